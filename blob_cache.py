@@ -0,0 +1,149 @@
+# encoding: utf-8
+
+"""
+Read-through, size-bounded on-disk cache for blob contents.
+
+A repeated read sends a single conditional request carrying the cached ETag;
+when the blob is unchanged the service answers 304 and the bytes are read
+from the local copy. They are read in one call rather than mapped: callers
+get `bytes`, so a mapping would be copied all the same.
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict, namedtuple
+from logging import getLogger
+
+from blob_transfer import get_verified_blob
+from tests.metrics import metrics
+
+LOG = getLogger('vendor.blob_cache')
+
+METRICS_NAME = 'object_storage_cache'
+
+CacheEntry = namedtuple('CacheEntry', ['filename', 'etag', 'size'])
+
+
+class BlobCache(object):
+    """
+    :param directory: directory the cache keeps its files in; a private
+                      sub-directory is created in it for this process.
+    :param max_bytes: total size of the cached contents, least recently used
+                      entries are evicted beyond it.
+    """
+
+    def __init__(self, directory, max_bytes):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = tempfile.mkdtemp(prefix='blob-cache-', dir=directory)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._size = 0
+        self._closed = False
+
+    def read(self, blob_client, container_name, path):
+        """
+        Return the contents of a blob, from the cache when still current. Once
+        the cache is closed, every read goes to the service.
+        """
+        from azure.common import AzureHttpError
+
+        if self._closed:
+            return get_verified_blob(blob_client, container_name, path).content
+
+        key = _key(blob_client, container_name, path)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+
+        if entry is None:
+            metrics.count(METRICS_NAME, 'miss')
+            blob = get_verified_blob(blob_client, container_name, path)
+        else:
+            metrics.count(METRICS_NAME, 'revalidation')
+            try:
+                blob = get_verified_blob(blob_client, container_name, path, if_none_match=entry.etag)
+            except AzureHttpError as ex:
+                if ex.status_code != 304:
+                    raise
+                content = self._load(key, entry)
+                if content is not None:
+                    metrics.count(METRICS_NAME, 'hit')
+                    return content
+                blob = get_verified_blob(blob_client, container_name, path)
+            else:
+                metrics.count(METRICS_NAME, 'stale')
+
+        self._store(key, blob.content, blob.properties.etag)
+        return blob.content
+
+    def invalidate(self, blob_client, container_name, path):
+        key = _key(blob_client, container_name, path)
+        with self._lock:
+            self._drop(key)
+
+    def close(self):
+        """Forget every entry and remove the files of this cache, which stops caching."""
+        with self._lock:
+            self._closed = True
+            self._entries.clear()
+            self._size = 0
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _load(self, key, entry):
+        try:
+            with open(entry.filename, 'rb', buffering=0) as f:
+                return f.read()
+        except OSError as ex:
+            LOG.debug('Dropping unreadable cache entry %s: %s', entry.filename, ex)
+            with self._lock:
+                if self._entries.get(key) == entry:
+                    self._drop(key)
+            return None
+
+    def _store(self, key, content, etag):
+        if self._closed or len(content) > self.max_bytes:
+            return
+
+        try:
+            fd, temporary = tempfile.mkstemp(dir=self.directory)
+        except FileNotFoundError:
+            # Closed while the blob was being downloaded.
+            return
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+
+        filename = os.path.join(self.directory, key)
+        with self._lock:
+            if self._closed:
+                shutil.rmtree(self.directory, ignore_errors=True)
+                return
+            os.replace(temporary, filename)
+            self._drop(key, unlink=False)
+            self._entries[key] = CacheEntry(filename=filename, etag=etag, size=len(content))
+            self._size += len(content)
+
+            while self._size > self.max_bytes:
+                evicted_key = next(iter(self._entries))
+                LOG.debug('Evicting %s from the blob cache', evicted_key)
+                self._drop(evicted_key)
+
+    def _drop(self, key, unlink=True):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self._size -= entry.size
+        if unlink:
+            try:
+                os.remove(entry.filename)
+            except FileNotFoundError:
+                pass
+
+
+def _key(blob_client, container_name, path):
+    name = '/'.join([blob_client.account_name, container_name, path])
+    return hashlib.sha256(name.encode()).hexdigest()
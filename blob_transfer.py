@@ -0,0 +1,295 @@
+# encoding: utf-8
+
+"""
+Parallel, memory-bounded block blob transfers.
+
+Uploads cut the source into fixed-size blocks that are sent concurrently and
+committed as a block list at the end. At most `concurrency` blocks are in
+flight at any time, so memory use does not depend on the size of the object.
+Downloads fetch byte ranges concurrently straight into a caller-supplied
+writable buffer such as a `bytearray`, `memoryview` or `mmap`.
+
+Every transfer is integrity checked without reading the data a second time:
+each block or range carries an MD5 checked by the service or the SDK, and a
+SHA-256 of the whole object is computed as the data streams through, stored
+as blob metadata on upload and verified on download.
+"""
+
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from logging import getLogger
+from time import monotonic
+
+from tests.metrics import metrics
+
+LOG = getLogger('vendor.blob_transfer')
+
+DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024
+DEFAULT_CONCURRENCY = 8
+
+SHA256_METADATA = 'sha256'
+METRICS_NAME = 'object_storage_integrity'
+
+
+class IntegrityError(Exception):
+    pass
+
+
+def put_verified_blob(blob_client, container_name, path, data,
+                      block_size=DEFAULT_BLOCK_SIZE, concurrency=DEFAULT_CONCURRENCY):
+    """Upload the bytes-like `data` as blocks with their MD5 and its SHA-256."""
+    upload_stream(blob_client, container_name, path, data, block_size=block_size, concurrency=concurrency)
+
+
+def get_verified_blob(blob_client, container_name, path, **kwargs):
+    """
+    Download a whole blob, checking the MD5 of every range and the SHA-256
+    recorded at upload time, which is computed as the ranges are received.
+
+    :returns: the blob, with its contents in `content`.
+    :raises IntegrityError: when the contents do not match their SHA-256.
+    """
+    digest = _Digest()
+    writer = _DigestWriter(digest)
+    # Ranges are only received in order, and so hashed as they arrive, with a
+    # single connection.
+    blob = blob_client.get_blob_to_stream(
+        container_name, path, writer, validate_content=True, max_connections=1, **kwargs)
+    blob.content = writer.getvalue()
+    digest.verify(path, blob.metadata)
+    digest.record('download')
+    return blob
+
+
+def upload_stream(blob_client, container_name, path, source,
+                  block_size=DEFAULT_BLOCK_SIZE, concurrency=DEFAULT_CONCURRENCY):
+    """
+    Upload `source`, a bytes-like object, a binary file object or an iterable
+    of bytes-like chunks.
+
+    :returns: the number of bytes uploaded.
+    """
+    from azure.storage.blob.models import BlobBlock
+
+    started_at = monotonic()
+    in_flight = threading.BoundedSemaphore(concurrency)
+    block_ids = []
+    futures = []
+    size = 0
+
+    digest = _Digest()
+
+    def put_block(block_id, block):
+        try:
+            blob_client.put_block(container_name, path, block, block_id, validate_content=True)
+        finally:
+            in_flight.release()
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='put-block') as executor:
+        try:
+            for index, block in enumerate(_blocks(source, block_size)):
+                in_flight.acquire()
+                digest.update(block)
+                block_id = '{:08d}'.format(index)
+                block_ids.append(block_id)
+                futures.append(executor.submit(put_block, block_id, block))
+                size += len(block)
+
+                # Surface failures early instead of uploading the whole source.
+                if futures[0].done():
+                    futures.pop(0).result()
+        finally:
+            for future in futures:
+                future.result()
+
+    blob_client.put_block_list(
+        container_name,
+        path,
+        [BlobBlock(id=block_id) for block_id in block_ids],
+        metadata={SHA256_METADATA: digest.hexdigest()},
+    )
+    digest.record('upload')
+
+    _log_throughput('Uploaded', path, size, len(block_ids), started_at)
+    return size
+
+
+def download_into(blob_client, container_name, path, buffer,
+                  block_size=DEFAULT_BLOCK_SIZE, concurrency=DEFAULT_CONCURRENCY):
+    """
+    Download a blob into `buffer`, which must be writable and large enough.
+
+    Every range is requested with the ETag of the blob, so a blob changing
+    while it is being downloaded fails the transfer instead of mixing versions.
+
+    :returns: the number of bytes downloaded.
+    """
+    started_at = monotonic()
+    blob = blob_client.get_blob_properties(container_name, path)
+    properties = blob.properties
+    size = properties.content_length
+
+    view = memoryview(buffer).cast('B')
+    if len(view) < size:
+        raise ValueError('{} is {} bytes, the buffer only holds {}'.format(path, size, len(view)))
+
+    def get_range(start):
+        end = min(start + block_size, size)
+        blob_client.get_blob_to_stream(
+            container_name,
+            path,
+            _BufferWriter(view[start:end]),
+            start_range=start,
+            end_range=end - 1,
+            if_match=properties.etag,
+            validate_content=True,
+            max_connections=1,
+        )
+        return start, end
+
+    # Ranges complete out of order; each contiguous run from the start is
+    # hashed as soon as it is complete, while later ranges are downloading.
+    digest = _Digest()
+    hashed_up_to = 0
+    completed = {}
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='get-range') as executor:
+        futures = [executor.submit(get_range, start) for start in range(0, size, block_size)]
+        for future in as_completed(futures):
+            start, end = future.result()
+            completed[start] = end
+            while hashed_up_to in completed:
+                end = completed.pop(hashed_up_to)
+                digest.update(view[hashed_up_to:end])
+                hashed_up_to = end
+
+    digest.verify(path, blob.metadata)
+    digest.record('download')
+
+    _log_throughput('Downloaded', path, size, -(-size // block_size), started_at)
+    return size
+
+
+def _blocks(source, block_size):
+    """Yield `block_size` chunks of `source`; only the last one may be shorter."""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        # The SDK only sends `bytes` blocks.
+        with memoryview(source) as base, base.cast('B') as view:
+            for start in range(0, len(view), block_size):
+                yield bytes(view[start:start + block_size])
+        return
+
+    if hasattr(source, 'read'):
+        while True:
+            block = _read_full(source, block_size)
+            if block:
+                yield block
+            if len(block) < block_size:
+                return
+
+    pending = bytearray()
+    for chunk in source:
+        pending += chunk
+        while len(pending) >= block_size:
+            yield bytes(pending[:block_size])
+            del pending[:block_size]
+    if pending:
+        yield bytes(pending)
+
+
+def _read_full(source, size):
+    """Read `size` bytes, or fewer only at the end of `source`."""
+    parts = []
+    remaining = size
+    while remaining:
+        part = source.read(remaining)
+        if not part:
+            break
+        parts.append(part)
+        remaining -= len(part)
+    return b''.join(parts)
+
+
+class _BufferWriter(object):
+    """Minimal writable stream filling a memoryview."""
+
+    def __init__(self, view):
+        self._view = view
+        self._position = 0
+
+    def write(self, data):
+        end = self._position + len(data)
+        self._view[self._position:end] = data
+        self._position = end
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def seekable(self):
+        return False
+
+
+class _DigestWriter(object):
+    """Writable stream hashing every chunk as it is written, then keeping it."""
+
+    def __init__(self, digest):
+        self._digest = digest
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data):
+        self._digest.update(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def seekable(self):
+        return False
+
+    def getvalue(self):
+        return b''.join(self._chunks)
+
+
+class _Digest(object):
+    """SHA-256 fed as data streams through, timing the hashing itself."""
+
+    def __init__(self):
+        self._hash = hashlib.sha256()
+        self.size = 0
+        self.elapsed = 0.0
+
+    def update(self, data):
+        started_at = monotonic()
+        self._hash.update(data)
+        self.elapsed += monotonic() - started_at
+        self.size += len(data)
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+    def verify(self, path, metadata):
+        expected = (metadata or {}).get(SHA256_METADATA)
+        if expected is None:
+            LOG.debug('%s has no %s metadata, skipping verification', path, SHA256_METADATA)
+        elif expected != self.hexdigest():
+            raise IntegrityError('{} has SHA-256 {}, expected {}'.format(path, self.hexdigest(), expected))
+
+    def record(self, name):
+        metrics.record(
+            METRICS_NAME,
+            name,
+            hash_time=self.elapsed,
+            hash_mb_per_s=self.size / self.elapsed / 1e6 if self.elapsed else 0.0,
+        )
+
+
+def _log_throughput(action, path, size, blocks, started_at):
+    elapsed = monotonic() - started_at
+    LOG.debug(
+        '%s %s: %d bytes in %d blocks, %.2fs (%.1f MB/s)',
+        action, path, size, blocks, elapsed, size / elapsed / 1e6 if elapsed else 0.0,
+    )
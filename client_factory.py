@@ -0,0 +1,102 @@
+# encoding: utf-8
+
+"""
+Azure management clients that share one credential and one HTTP session.
+
+The Azure CLI profile is loaded once, the ARM token is cached and refreshed in
+the background ahead of its expiry, and every client sends its requests
+through the same pooled `requests.Session`. The size of that pool bounds how
+many ARM calls can be in flight at once.
+"""
+
+import threading
+from logging import getLogger
+
+LOG = getLogger('vendor.client_factory')
+
+
+class ClientFactory(object):
+    """Create and cache management clients, one per client type."""
+
+    def __init__(self, base_url='', pool_size=16):
+        self.base_url = base_url
+        self.pool_size = pool_size
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._credentials = None
+        self._session = None
+
+    def get(self, client_type):
+        with self._lock:
+            client = self._clients.get(client_type)
+            if client is None:
+                client = self._clients[client_type] = self._create(client_type)
+            return client
+
+    def close(self):
+        with self._lock:
+            if self._credentials is not None:
+                self._credentials.stop()
+            if self._session is not None:
+                self._session.close()
+            self._clients.clear()
+            self._credentials = None
+            self._session = None
+
+    def _create(self, client_type):
+        # azure-cli-core and msrest are slow to import and only needed for the
+        # first client.
+        from azure.cli.core._profile import Profile
+        from azure.common.client_factory import get_client_from_cli_profile
+        from token_credentials import RefreshingTokenCredentials
+
+        if self._credentials is None:
+            LOG.debug('Loading Azure CLI profile')
+            self._credentials = RefreshingTokenCredentials(Profile())
+            self._credentials.start()
+            self._session = _pooled_session(self.pool_size)
+
+        client_args = {}
+        if self.base_url:
+            client_args['base_url'] = self.base_url
+            LOG.debug('Using custom ARM endpoint %s for %s', self.base_url, client_type.__name__)
+        else:
+            LOG.debug('Using default ARM endpoint for %s', client_type.__name__)
+
+        client = get_client_from_cli_profile(
+            client_type,
+            credentials=self._credentials,
+            subscription_id=self._credentials.subscription_id,
+            **client_args
+        )
+        _share_session(client, self._session)
+
+        return client
+
+
+def _pooled_session(pool_size):
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, pool_block=True)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def _share_session(client, session):
+    """
+    Send the requests of `client` through `session`: msrest hands the requests
+    keyword arguments returned by its session configuration callback to the
+    sender, which uses the `session` among them instead of its own.
+    """
+    def configure(own_session, global_config, local_config, **kwargs):
+        kwargs['session'] = session
+        return kwargs
+
+    client.config.keep_alive = True
+    client.config.session_configuration_callback = configure
+    # msrest sets its retry policy on the adapters of the sessions it creates.
+    for adapter in session.adapters.values():
+        adapter.max_retries = client.config.retry_policy()
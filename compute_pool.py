@@ -0,0 +1,178 @@
+# encoding: utf-8
+
+"""
+Pool of pre-provisioned VMs that compute helpers can lease from.
+
+The pool knows nothing about Azure: it is driven by `provision` and `reset`
+callables, so its lifecycle can be exercised against fake clients.
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from enum import Enum
+from logging import getLogger
+from time import monotonic
+
+LOG = getLogger('vendor.compute_pool')
+
+
+class VmState(Enum):
+    PROVISIONING = 'provisioning'
+    READY = 'ready'
+    LEASED = 'leased'
+    RESETTING = 'resetting'
+    FAILED = 'failed'
+    DRAINED = 'drained'
+
+
+_TRANSITIONS = {
+    VmState.PROVISIONING: {VmState.READY, VmState.FAILED, VmState.DRAINED},
+    VmState.READY: {VmState.LEASED, VmState.DRAINED},
+    VmState.LEASED: {VmState.RESETTING, VmState.DRAINED},
+    VmState.RESETTING: {VmState.READY, VmState.FAILED, VmState.DRAINED},
+    VmState.FAILED: {VmState.DRAINED},
+    VmState.DRAINED: set(),
+}
+
+# States from which a VM will become available for leasing later on.
+_PENDING_STATES = {VmState.PROVISIONING, VmState.RESETTING}
+
+
+class InvalidTransition(Exception):
+    pass
+
+
+class PooledVm(object):
+    def __init__(self, slot):
+        self.slot = slot
+        self.handle = None
+        self.state = VmState.PROVISIONING
+        self.leases = 0
+
+    def transition(self, state):
+        if state not in _TRANSITIONS[self.state]:
+            raise InvalidTransition('VM slot {} cannot go from {} to {}'.format(self.slot, self.state.value, state.value))
+        LOG.debug('VM slot %d: %s -> %s', self.slot, self.state.value, state.value)
+        self.state = state
+
+
+class ComputePool(object):
+    """
+    Warm pool of compute instances.
+
+    :param size: number of VMs to keep in the pool.
+    :param provision: callable taking a count and returning that many handles.
+    :param reset: callable taking a handle and cleaning the VM up after a lease.
+    """
+
+    def __init__(self, size, provision, reset):
+        self.size = size
+        self._provision = provision
+        self._reset = reset
+        self._vms = [PooledVm(slot) for slot in range(size)]
+        self._condition = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=max(size, 1), thread_name_prefix='compute-pool')
+
+    def fill(self):
+        """Start provisioning every VM of the pool in the background."""
+        LOG.debug('Provisioning %d pooled VMs', self.size)
+        return self._executor.submit(self._fill)
+
+    def lease(self, timeout=None):
+        """
+        Take a ready VM out of the pool, waiting for one that is still being
+        provisioned or reset if needed.
+
+        :returns: the handle of the leased VM, or None if no VM became
+                  available in time.
+        """
+        deadline = None if timeout is None else monotonic() + timeout
+
+        with self._condition:
+            while True:
+                for vm in self._vms:
+                    if vm.state is VmState.READY:
+                        vm.transition(VmState.LEASED)
+                        vm.leases += 1
+                        LOG.debug('Leased pooled VM %s', vm.handle.name)
+                        return vm.handle
+
+                if not any(vm.state in _PENDING_STATES for vm in self._vms):
+                    return None
+
+                remaining = None if deadline is None else deadline - monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._condition.wait(remaining)
+
+    def release(self, handle):
+        """Give a leased VM back; it is reset in the background."""
+        with self._condition:
+            vm = self._find(handle)
+            vm.transition(VmState.RESETTING)
+        self._executor.submit(self._reset_vm, vm)
+
+    @contextmanager
+    def leased(self, timeout=None):
+        handle = self.lease(timeout)
+        try:
+            yield handle
+        finally:
+            if handle is not None:
+                self.release(handle)
+
+    def states(self):
+        with self._condition:
+            return {vm.slot: vm.state for vm in self._vms}
+
+    def drain(self):
+        """
+        Wait for in-flight provisioning and resets, then mark every VM as
+        drained. Destroying the VMs themselves is left to the caller.
+        """
+        self._executor.shutdown(wait=True)
+        with self._condition:
+            for vm in self._vms:
+                if vm.state is not VmState.DRAINED:
+                    vm.transition(VmState.DRAINED)
+            self._condition.notify_all()
+        LOG.debug('Drained compute pool: %s', ', '.join('{} leases on slot {}'.format(vm.leases, vm.slot) for vm in self._vms))
+
+    def _fill(self):
+        try:
+            handles = self._provision(self.size)
+        except Exception as ex:
+            LOG.warning('Unable to provision pooled VMs: %s', ex)
+            handles = []
+
+        with self._condition:
+            for vm in self._vms:
+                if vm.state is not VmState.PROVISIONING:
+                    continue
+                if vm.slot < len(handles):
+                    vm.handle = handles[vm.slot]
+                    vm.transition(VmState.READY)
+                else:
+                    vm.transition(VmState.FAILED)
+            self._condition.notify_all()
+
+    def _reset_vm(self, vm):
+        try:
+            self._reset(vm.handle)
+        except Exception as ex:
+            LOG.warning('Unable to reset pooled VM %s, retiring it: %s', vm.handle.name, ex)
+            state = VmState.FAILED
+        else:
+            state = VmState.READY
+
+        with self._condition:
+            if vm.state is VmState.RESETTING:
+                vm.transition(state)
+            self._condition.notify_all()
+
+    def _find(self, handle):
+        for vm in self._vms:
+            if vm.handle == handle:
+                return vm
+        raise KeyError('{} is not part of the compute pool'.format(handle))
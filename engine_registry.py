@@ -0,0 +1,197 @@
+# encoding: utf-8
+
+"""
+Shared, pre-warmed SQLAlchemy engines, one per database.
+
+Engines use a tuned connection pool that is filled with connections opened in
+parallel as soon as the database is ready. Their TLS context reuses the
+session of the previous handshake, so new connections skip the full
+handshake, and pool checkouts are timed for the metrics report.
+"""
+
+import ssl
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from time import monotonic
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import QueuePool
+
+from tests.metrics import metrics
+
+LOG = getLogger('vendor.engine_registry')
+
+METRICS_NAME = 'relational_engine'
+
+# Longest statement text kept on a query span.
+SPAN_STATEMENT_LENGTH = 200
+
+
+class ResumingSSLContext(ssl.SSLContext):
+    """SSL context offering the last negotiated session on every new connection."""
+
+    _session = None
+
+    def wrap_socket(self, sock, *args, **kwargs):
+        if self._session is not None:
+            kwargs.setdefault('session', self._session)
+        wrapped = super(ResumingSSLContext, self).wrap_socket(sock, *args, **kwargs)
+
+        metrics.count(METRICS_NAME, 'tls_resumed' if wrapped.session_reused else 'tls_full_handshake')
+        if wrapped.session is not None:
+            self._session = wrapped.session
+        return wrapped
+
+
+def resuming_ssl_context(cafile, check_hostname=True):
+    context = ResumingSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.load_verify_locations(cafile=cafile)
+    context.check_hostname = check_hostname
+    return context
+
+
+class CheckoutStats(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.total = 0.0
+        self.slowest = 0.0
+        self.waited = 0.0
+
+    def add(self, elapsed, exhausted):
+        with self._lock:
+            self.checkouts += 1
+            self.total += elapsed
+            self.slowest = max(self.slowest, elapsed)
+            if exhausted:
+                self.waited += elapsed
+
+
+class TimedQueuePool(QueuePool):
+    """`QueuePool` measuring how long checkouts take and how long they wait."""
+
+    stats = None
+
+    def _do_get(self):
+        exhausted = self.checkedout() >= self.size() + self._max_overflow
+        started_at = monotonic()
+        try:
+            return super(TimedQueuePool, self)._do_get()
+        finally:
+            ended_at = monotonic()
+            if self.stats is not None:
+                self.stats.add(ended_at - started_at, exhausted)
+            metrics.record_span('checkout', 'pool', started_at, ended_at, exhausted=exhausted)
+
+
+class EngineRegistry(object):
+    """
+    :param wait_until_ready: callable taking a new engine and returning once
+                             the database accepts connections.
+    :param prewarm: number of connections opened in parallel on a new engine.
+    :param engine_options: keyword arguments for `create_engine`, such as
+                           `pool_size`, `max_overflow`, `pool_pre_ping` and
+                           `pool_recycle`.
+    """
+
+    def __init__(self, wait_until_ready, prewarm=0, **engine_options):
+        self._wait_until_ready = wait_until_ready
+        self.prewarm = prewarm
+        self.engine_options = engine_options
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._engines = {}
+
+    def get(self, key, url, connect_args):
+        """Return the engine for `key`, creating and warming it on first use."""
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            engine = self._engines.get(key)
+            if engine is None:
+                engine = self._create(url, connect_args)
+                self._engines[key] = engine
+            return engine
+
+    def dispose(self, key):
+        """Close the pooled connections of the engine for `key` and forget it."""
+        with self._lock:
+            engine = self._engines.pop(key, None)
+            self._key_locks.pop(key, None)
+        if engine is not None:
+            _dispose(engine)
+
+    def dispose_all(self):
+        with self._lock:
+            engines = list(self._engines.values())
+            self._engines.clear()
+            self._key_locks.clear()
+        for engine in engines:
+            _dispose(engine)
+
+    def _create(self, url, connect_args):
+        engine = create_engine(url, poolclass=TimedQueuePool, connect_args=connect_args, **self.engine_options)
+        engine.pool.stats = CheckoutStats()
+        event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+        self._wait_until_ready(engine)
+        if self.prewarm:
+            started_at = monotonic()
+            with ThreadPoolExecutor(max_workers=self.prewarm, thread_name_prefix='prewarm') as executor:
+                futures = [executor.submit(engine.connect) for _ in range(self.prewarm)]
+
+            # Return every connection that opened to the pool, even when
+            # others failed, before surfacing the first error.
+            error = None
+            for future in futures:
+                try:
+                    future.result().close()
+                except Exception as ex:
+                    error = error or ex
+            if error is not None:
+                LOG.debug('Pre-warming %s failed with %d connections pooled', engine.url.host, engine.pool.checkedin())
+                engine.dispose()
+                raise error
+            LOG.debug('Pre-warmed %d connections to %s in %.2fs', self.prewarm, engine.url.host, monotonic() - started_at)
+
+        return engine
+
+
+def _dispose(engine):
+    stats = engine.pool.stats
+    if stats.checkouts:
+        metrics.record(
+            METRICS_NAME,
+            str(engine.url.host or engine.url.get_backend_name()),
+            checkouts=stats.checkouts,
+            checkout_avg_time=stats.total / stats.checkouts,
+            checkout_max_time=stats.slowest,
+            pool_wait_time=stats.waited,
+        )
+    engine.dispose()
+
+
+# The start time is kept on the execution context of the statement, which is
+# discarded with it, so a statement that raises leaves nothing behind on the
+# pooled connection. Statements run without a context are not timed.
+
+def _before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.query_started_at = monotonic()
+
+
+def _after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    started_at = getattr(context, 'query_started_at', None)
+    if started_at is None:
+        return
+    metrics.record_span(
+        statement.split(None, 1)[0].upper() if statement.strip() else 'query',
+        'sql',
+        started_at,
+        monotonic(),
+        statement=statement[:SPAN_STATEMENT_LENGTH],
+        executemany=executemany,
+    )
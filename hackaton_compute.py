@@ -1,9 +1,26 @@
-from typing import List, Tuple
+from concurrent.futures import Future
+from typing import Dict, List, Optional, Tuple, Union
+from uuid import uuid4
 
 from azure.mgmt.compute import ComputeManagementClient
 from azure.mgmt.compute.models import *
 from azure.mgmt.network import NetworkManagementClient
 
+from lro import OperationGraph
+
+VNET_NAME = 'hackaton-vnet'
+SUBNET_NAME = 'hackaton-subnet'
+VM_SIZE = 'Standard_DS1_v2'
+MAX_DATA_DISKS = 64
+DATA_DISK_SIZE_GB = 4
+VM_IMAGE = {
+    'publisher': 'Canonical',
+    'offer': 'UbuntuServer',
+    'sku': '18.04-LTS',
+    'version': 'latest',
+}
+
+
 def deploy_shared_network(
     resource_group_name: str,
     location: str,
@@ -14,10 +31,10 @@ def deploy_shared_network(
     - Resource group already exists
     - Network mgmt client is authenticated and ready to use
     """
-    # TODO Create a subnet
-    raise NotImplementedError("Create a Subnet")
+    graph = OperationGraph('network {}'.format(resource_group_name))
+    _add_subnet(graph, resource_group_name, location, network_management_client)
 
-    return subnet_id
+    return graph.run()['subnet']
 
 
 def deploy_vm_networking(
@@ -32,10 +49,12 @@ def deploy_vm_networking(
     - Resource group already exists
     - Network mgmt client is authenticated and ready to use
     """
-    # TODO Create network components for a VM
-    raise NotImplementedError("Create network components for a VM")
+    graph = OperationGraph('networking {}'.format(vm_name))
+    graph.add_value('subnet', subnet_id)
+    _add_vm_networking(graph, resource_group_name, location, vm_name, network_management_client)
+    results = graph.run()
 
-    return nic_id, public_ip_address
+    return results[vm_name + '/nic'], results[vm_name + '/public-ip']
 
 
 def deploy_vm(
@@ -52,10 +71,150 @@ def deploy_vm(
     - Resource group already exists
     - Compute mgmt client is authenticated and ready to use
     """
-    # TODO Create a VM that you can SSH into
-    raise NotImplementedError("Create a VM that you can SSH into")
+    graph = OperationGraph('vm {}'.format(vm_name))
+    graph.add_value(vm_name + '/nic', nic_id)
+    _add_vm(graph, resource_group_name, location, vm_name, admin_user_name, public_key, compute_management_client)
+
+    return graph.run()[vm_name + '/vm']
+
+
+def deploy_vms(
+    resource_group_name: str,
+    location: str,
+    vm_names: List[str],
+    admin_user_name: str,
+    public_key: str,
+    network_management_client: NetworkManagementClient,
+    compute_management_client: ComputeManagementClient,
+    subnet_id: Optional[Union[str, Future]] = None,
+) -> Dict[str, Tuple[VirtualMachine, str]]:
+    """Create publicly accessible VMs, and the network they need, in one go
+
+    Every operation is started as soon as its inputs exist: the subnet, public
+    IPs and NSGs are created together, NICs wait on those and VMs wait on
+    their NIC. Returns the VM and its public IP address, keyed by VM name.
+
+    - Resource group already exists
+    - Mgmt clients are authenticated and ready to use
+    - When no subnet_id is given, the shared subnet is created as well. It
+      may also be a future resolving to the subnet id, which is then waited
+      on alongside the other operations.
+    """
+    graph = OperationGraph('compute {}'.format(resource_group_name))
+    if subnet_id is None:
+        _add_subnet(graph, resource_group_name, location, network_management_client)
+    else:
+        graph.add_value('subnet', subnet_id)
+
+    for vm_name in vm_names:
+        _add_vm_networking(graph, resource_group_name, location, vm_name, network_management_client)
+        _add_vm(graph, resource_group_name, location, vm_name, admin_user_name, public_key, compute_management_client)
+
+    results = graph.run()
+
+    return {
+        vm_name: (results[vm_name + '/vm'], results[vm_name + '/public-ip'])
+        for vm_name in vm_names
+    }
+
+
+def _add_subnet(graph, resource_group_name, location, network_management_client):
+    graph.add('vnet', lambda _: network_management_client.virtual_networks.create_or_update(
+        resource_group_name,
+        VNET_NAME,
+        {
+            'location': location,
+            'address_space': {'address_prefixes': ['10.0.0.0/16']},
+            'subnets': [{'name': SUBNET_NAME, 'address_prefix': '10.0.0.0/24'}],
+        },
+    ))
+    graph.add('subnet', lambda results: results['vnet'].subnets[0].id, depends_on=['vnet'])
+
 
-    return vm
+def _add_vm_networking(graph, resource_group_name, location, vm_name, network_management_client):
+    graph.add(vm_name + '/public-ip-address', lambda _: network_management_client.public_ip_addresses.create_or_update(
+        resource_group_name,
+        vm_name + '-ip',
+        {
+            'location': location,
+            'public_ip_allocation_method': 'Static',
+        },
+    ))
+    graph.add(
+        vm_name + '/public-ip',
+        lambda results: results[vm_name + '/public-ip-address'].ip_address,
+        depends_on=[vm_name + '/public-ip-address'],
+    )
+    graph.add(vm_name + '/nsg', lambda _: network_management_client.network_security_groups.create_or_update(
+        resource_group_name,
+        vm_name + '-nsg',
+        {
+            'location': location,
+            'security_rules': [{
+                'name': 'ssh',
+                'protocol': 'Tcp',
+                'source_port_range': '*',
+                'destination_port_range': '22',
+                'source_address_prefix': '*',
+                'destination_address_prefix': '*',
+                'access': 'Allow',
+                'priority': 100,
+                'direction': 'Inbound',
+            }],
+        },
+    ))
+    graph.add(
+        vm_name + '/network-interface',
+        lambda results: network_management_client.network_interfaces.create_or_update(
+            resource_group_name,
+            vm_name + '-nic',
+            {
+                'location': location,
+                'network_security_group': {'id': results[vm_name + '/nsg'].id},
+                'ip_configurations': [{
+                    'name': 'ipconfig1',
+                    'subnet': {'id': results['subnet']},
+                    'public_ip_address': {'id': results[vm_name + '/public-ip-address'].id},
+                }],
+            },
+        ),
+        depends_on=['subnet', vm_name + '/public-ip-address', vm_name + '/nsg'],
+    )
+    graph.add(
+        vm_name + '/nic',
+        lambda results: results[vm_name + '/network-interface'].id,
+        depends_on=[vm_name + '/network-interface'],
+    )
+
+
+def _add_vm(graph, resource_group_name, location, vm_name, admin_user_name, public_key, compute_management_client):
+    graph.add(
+        vm_name + '/vm',
+        lambda results: compute_management_client.virtual_machines.create_or_update(
+            resource_group_name,
+            vm_name,
+            {
+                'location': location,
+                'hardware_profile': {'vm_size': VM_SIZE},
+                'storage_profile': {'image_reference': VM_IMAGE},
+                'os_profile': {
+                    'computer_name': vm_name,
+                    'admin_username': admin_user_name,
+                    'linux_configuration': {
+                        'disable_password_authentication': True,
+                        'ssh': {
+                            'public_keys': [{
+                                'path': '/home/{}/.ssh/authorized_keys'.format(admin_user_name),
+                                'key_data': public_key,
+                            }],
+                        },
+                    },
+                },
+                'network_profile': {'network_interfaces': [{'id': results[vm_name + '/nic']}]},
+            },
+        ),
+        depends_on=[vm_name + '/nic'],
+    )
 
 
 def create_disk(
@@ -68,8 +227,16 @@ def create_disk(
     - Resource group already exists
     - Compute mgmt client is authenticated and ready to use
     """
-    # TODO Create a managed disk
-    raise NotImplementedError("Create a managed disk")
+    poller = compute_management_client.disks.create_or_update(
+        resource_group_name,
+        'disk{}'.format(uuid4().hex[:20]),
+        {
+            'location': location,
+            'disk_size_gb': DATA_DISK_SIZE_GB,
+            'creation_data': {'create_option': DiskCreateOption.empty},
+        },
+    )
+    disk_id = poller.result().id
 
     return disk_id
 
@@ -79,14 +246,30 @@ def attach_disk(
     virtual_machine_name: str,
     disk_id: str,
     compute_management_client: ComputeManagementClient
-) -> None:
+) -> int:
     """Attach the given disk to the given VM
 
+    Returns the LUN the disk was attached to, which is how the guest finds it
+    under /dev/disk/azure/scsi1/.
+
     - Resource group, VM and disk exist already
     - Compute mgmt client is authenticated and ready to use
     """
-    # TODO Attach the given disk to the given VM
-    raise NotImplementedError("Attach the given disk to the given VM")
+    vm = compute_management_client.virtual_machines.get(resource_group_name, virtual_machine_name)
+    data_disks = vm.storage_profile.data_disks
+    used_luns = {data_disk.lun for data_disk in data_disks}
+    lun = next(lun for lun in range(MAX_DATA_DISKS) if lun not in used_luns)
+
+    data_disks.append(DataDisk(
+        lun=lun,
+        name=disk_id.split('/')[-1],
+        create_option=DiskCreateOptionTypes.attach,
+        managed_disk=ManagedDiskParameters(id=disk_id),
+    ))
+    compute_management_client.virtual_machines.create_or_update(resource_group_name, virtual_machine_name, vm).result()
+
+    return lun
+
 
 def detach_disk(
     resource_group_name: str,
@@ -99,8 +282,12 @@ def detach_disk(
     - Resource group, VM and disk exist already
     - Compute mgmt client is authenticated and ready to use
     """
-    # TODO Detach the given disk from the given VM
-    raise NotImplementedError("Detach the given disk from the given VM")
+    vm = compute_management_client.virtual_machines.get(resource_group_name, virtual_machine_name)
+    vm.storage_profile.data_disks = [
+        data_disk for data_disk in vm.storage_profile.data_disks
+        if not (data_disk.managed_disk and data_disk.managed_disk.id.lower() == disk_id.lower())
+    ]
+    compute_management_client.virtual_machines.create_or_update(resource_group_name, virtual_machine_name, vm).result()
 
 
 def execute_script(
@@ -119,9 +306,16 @@ def execute_script(
     - The "script" is the array of lines. Most of the solution will directly takes this format
       and do not require any encoding or changes.
     """
-    stdout_msg = None
+    poller = compute_management_client.virtual_machines.run_command(
+        resource_group_name,
+        virtual_machine_name,
+        {
+            'command_id': 'RunShellScript',
+            'script': script,
+        },
+    )
+    result = poller.result()
 
-    # TODO Execute this shell script on the givem VM
-    raise NotImplementedError("Execute this shell script on the givem VM")
+    stdout_msg = '\n'.join(status.message for status in result.value or [] if status.message) or None
 
     return stdout_msg
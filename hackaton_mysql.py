@@ -1,14 +1,19 @@
 from typing import Tuple
+from uuid import uuid4
 
 from azure.mgmt.rdbms.mysql import MySQLManagementClient
 from azure.mgmt.rdbms.mysql.models import *
 
+DATABASE_NAME = 'hackatondb'
+SERVER_SKU = 'B_Gen5_1'
+
 
 def create_mysql_database(
     resource_group_name: str,
     administrator_login: str,
     administrator_login_password: str,
-    mysql_mgmt_client: MySQLManagementClient
+    mysql_mgmt_client: MySQLManagementClient,
+    location: str = 'eastus',
 ) -> Tuple[str, str, str]:
     """Create a MySQL server, database and necessary config to connect to it.
 
@@ -17,8 +22,39 @@ def create_mysql_database(
     - Resource group exists already
     - MySQL mgmt client is authenticated and ready to use
     """
+    server_name = 'hackaton{}'.format(uuid4().hex[:16])
+
+    server = mysql_mgmt_client.servers.create(
+        resource_group_name,
+        server_name,
+        ServerForCreate(
+            location=location,
+            sku=Sku(name=SERVER_SKU),
+            properties=ServerPropertiesForDefaultCreate(
+                administrator_login=administrator_login,
+                administrator_login_password=administrator_login_password,
+                version=ServerVersion.five_full_stop_seven,
+                ssl_enforcement=SslEnforcementEnum.enabled,
+            ),
+        ),
+    ).result()
 
-    # TODO Create server, database and configure as necessary
-    raise NotImplementedError("Create server, database and configure as necessary")
+    # The firewall rule and the database do not depend on each other.
+    firewall_poller = mysql_mgmt_client.firewall_rules.create_or_update(
+        resource_group_name,
+        server_name,
+        'allow-all',
+        '0.0.0.0',
+        '255.255.255.255',
+    )
+    database_poller = mysql_mgmt_client.databases.create_or_update(
+        resource_group_name,
+        server_name,
+        DATABASE_NAME,
+        charset='utf8',
+        collation='utf8_general_ci',
+    )
+    firewall_poller.result()
+    database_poller.result()
 
-    return server_name, database_name, host
+    return server_name, DATABASE_NAME, server.fully_qualified_domain_name
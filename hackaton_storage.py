@@ -1,4 +1,5 @@
 from typing import Tuple
+from uuid import uuid4
 
 from azure.mgmt.storage import StorageManagementClient
 from azure.mgmt.storage.models import *
@@ -7,15 +8,29 @@ from azure.mgmt.storage.models import *
 
 def create_storage_account(
         resource_group_name: str,
-        storage_management_client: StorageManagementClient
+        storage_management_client: StorageManagementClient,
+        location: str = 'eastus',
+        sku: str = 'Standard_LRS',
 ) -> Tuple[str, str]:
     """Create a storage account and return the account name and the key.
 
     - Resource group exists already
     - Storage mgmt client is authenticated and ready to use
     """
+    account_name = 'hackaton{}'.format(uuid4().hex[:16])
 
-    # TODO Create a storage account
-    raise NotImplementedError("You need to create a storage account")
+    poller = storage_management_client.storage_accounts.create(
+        resource_group_name,
+        account_name,
+        {
+            'location': location,
+            'sku': {'name': sku},
+            'kind': Kind.storage_v2,
+        },
+    )
+    poller.result()
+
+    keys = storage_management_client.storage_accounts.list_keys(resource_group_name, account_name)
+    account_key = keys.keys[0].value
 
     return account_name, account_key
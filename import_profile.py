@@ -0,0 +1,80 @@
+# encoding: utf-8
+
+"""
+Break down the import time of the harness with `python -X importtime`.
+
+The statement is run in a fresh interpreter, so modules already imported by
+the calling process do not hide their cost.
+"""
+
+import subprocess
+import sys
+from collections import Counter, namedtuple
+from pathlib import Path
+
+CWD = Path(__file__).resolve().parent
+
+TOP_PACKAGES = 15
+TOP_MODULES = 20
+
+ImportTime = namedtuple('ImportTime', ['module', 'depth', 'self_us', 'cumulative_us'])
+
+
+def profile(statement):
+    """
+    Run `statement` under `-X importtime` in a new interpreter.
+
+    :returns: a list of :class:`ImportTime`, in the order they were reported.
+    """
+    completed = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', statement],
+        cwd=str(CWD),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    timings = parse(completed.stderr)
+    if completed.returncode != 0 and not timings:
+        raise RuntimeError('Profiling {!r} failed:\n{}'.format(statement, completed.stderr))
+    return timings
+
+
+def parse(output):
+    timings = []
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue
+        name = fields[2].rstrip()
+        module = name.lstrip()
+        timings.append(ImportTime(
+            module=module,
+            depth=(len(name) - len(module)) // 2,
+            self_us=int(fields[0]),
+            cumulative_us=int(fields[1]),
+        ))
+    return timings
+
+
+def report(timings, top_packages=TOP_PACKAGES, top_modules=TOP_MODULES):
+    if not timings:
+        print("No import times reported")
+        return
+
+    top_depth = min(timing.depth for timing in timings)
+    total = sum(timing.cumulative_us for timing in timings if timing.depth == top_depth)
+    print("Imported {} modules in {:.1f}ms".format(len(timings), total / 1000))
+
+    by_package = Counter()
+    for timing in timings:
+        by_package[timing.module.split('.')[0]] += timing.self_us
+    print("\nBy top-level package (self time):")
+    for package, self_us in by_package.most_common(top_packages):
+        print("  {:>9.1f}ms {:>5.1%}  {}".format(self_us / 1000, self_us / total, package))
+
+    print("\nSlowest imports (cumulative time):")
+    for timing in sorted(timings, key=lambda timing: timing.cumulative_us, reverse=True)[:top_modules]:
+        print("  {:>9.1f}ms {:>5.1%}  {}{}".format(
+            timing.cumulative_us / 1000, timing.cumulative_us / total, '  ' * (timing.depth - top_depth), timing.module))
@@ -0,0 +1,149 @@
+# encoding: utf-8
+
+"""
+Run a graph of dependent Azure long-running operations.
+
+Each operation is submitted as soon as every operation it depends on has
+completed, and all in-flight pollers are watched from a single loop, so the
+whole graph takes as long as its longest dependency chain.
+"""
+
+from collections import OrderedDict
+from logging import getLogger
+from time import monotonic, sleep
+
+from tests.metrics import metrics
+
+LOG = getLogger('vendor.lro')
+
+POLLING_INTERVAL_SECONDS = 0.5
+
+
+class Operation(object):
+    """A node of an :class:`OperationGraph`."""
+
+    def __init__(self, name, submit, depends_on):
+        self.name = name
+        self.submit = submit
+        self.depends_on = tuple(depends_on)
+        self.poller = None
+        self.result = None
+        self.submitted_at = None
+        self.completed_at = None
+
+    @property
+    def duration(self):
+        return self.completed_at - self.submitted_at
+
+
+class OperationGraph(object):
+    """
+    Dependency graph of ARM operations.
+
+    `submit` callables receive a mapping of the results of the operations they
+    depend on, keyed by name, and return either a poller (anything with
+    `done()` and `result()`) or a plain value for operations that completed
+    synchronously.
+    """
+
+    def __init__(self, name, polling_interval_seconds=POLLING_INTERVAL_SECONDS):
+        self.name = name
+        self.polling_interval_seconds = polling_interval_seconds
+        self.operations = OrderedDict()
+
+    def add(self, name, submit, depends_on=()):
+        if name in self.operations:
+            raise ValueError('Operation {} is already part of {}'.format(name, self.name))
+        for dependency in depends_on:
+            if dependency not in self.operations:
+                raise ValueError('Operation {} depends on unknown operation {}'.format(name, dependency))
+        self.operations[name] = Operation(name, submit, depends_on)
+
+    def add_value(self, name, value):
+        """
+        Add an operation whose result is already known, or is being produced
+        elsewhere when `value` is a poller or future.
+        """
+        self.add(name, lambda results: value)
+
+    def run(self):
+        """
+        Submit and wait on every operation of the graph.
+
+        :returns: a mapping of operation name to result.
+        """
+        with metrics.span(self.name, 'arm'):
+            return self._run()
+
+    def _run(self):
+        started_at = monotonic()
+        pending = list(self.operations.values())
+        in_flight = []
+        results = {}
+
+        while pending or in_flight:
+            progressed = False
+
+            for operation in [op for op in pending if all(dep in results for dep in op.depends_on)]:
+                pending.remove(operation)
+                operation.submitted_at = monotonic()
+                LOG.debug('[%s] Submitting %s', self.name, operation.name)
+                with metrics.span(operation.name, 'arm'):
+                    submitted = operation.submit({dep: results[dep] for dep in operation.depends_on})
+                if _is_poller(submitted):
+                    operation.poller = submitted
+                    in_flight.append(operation)
+                else:
+                    self._complete(operation, submitted, results)
+                progressed = True
+
+            for operation in [op for op in in_flight if op.poller.done()]:
+                in_flight.remove(operation)
+                self._complete(operation, operation.poller.result(), results)
+                metrics.record_span(
+                    operation.name, 'poll', operation.submitted_at, operation.completed_at, asynchronous=True)
+                progressed = True
+
+            if not progressed:
+                sleep(self.polling_interval_seconds)
+
+        LOG.info('[%s] Completed %d operations in %.2fs', self.name, len(self.operations), monotonic() - started_at)
+        self._log_critical_path(started_at)
+
+        return results
+
+    def critical_path(self):
+        """
+        The chain of operations that determined the total run time, following
+        for every operation the dependency that completed last.
+        """
+        if not self.operations:
+            return []
+
+        operation = max(self.operations.values(), key=lambda op: op.completed_at)
+        path = [operation]
+        while operation.depends_on:
+            operation = max((self.operations[dep] for dep in operation.depends_on), key=lambda op: op.completed_at)
+            path.append(operation)
+
+        return list(reversed(path))
+
+    def _complete(self, operation, result, results):
+        operation.completed_at = monotonic()
+        operation.result = result
+        results[operation.name] = result
+        LOG.debug('[%s] %s completed in %.2fs', self.name, operation.name, operation.duration)
+
+    def _log_critical_path(self, started_at):
+        path = self.critical_path()
+        if path:
+            LOG.info(
+                '[%s] Critical path (%.2fs): %s',
+                self.name,
+                path[-1].completed_at - started_at,
+                ' -> '.join('{} ({:.2f}s)'.format(op.name, op.duration) for op in path),
+            )
+
+
+def _is_poller(value):
+    return callable(getattr(value, 'done', None)) and callable(getattr(value, 'result', None))
@@ -20,12 +20,12 @@ Please ensure that all submissions run correctly under Python 3.
 
 
 def dep_check(*modules):
+    # Only locate the modules: importing them here would load paramiko and
+    # sqlalchemy before any test case needs them.
+    import importlib.util
     error = False
     for module in modules:
-        import importlib
-        try:
-            importlib.import_module(module)
-        except ModuleNotFoundError:
+        if importlib.util.find_spec(module) is None:
             error = True
             print("Dependency missing: {}".format(module))
     if error:
@@ -35,8 +35,15 @@ dep_check("colorama", "sqlalchemy", "paramiko")
 
 
 from colorama import Fore, Style
+import argparse
 import contextlib
+import inspect
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tests import test, metrics
+from tests.metrics import find_regressions
+from tests.common import buffered_output
 import vendor
 
 
@@ -51,10 +58,100 @@ def test_environment():
         vendor.teardown_environment()
 
 
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="Run the vendor test harness.")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1,
+        help="number of test cases to run concurrently, each in its own resource group (default: 1)")
+    parser.add_argument(
+        "-k", "--case", action="append", dest="cases", metavar="NAME",
+        help="only run the test cases whose name contains NAME, may be repeated")
+    parser.add_argument(
+        "--profile-import", action="store_true",
+        help="report how long importing the harness and its dependencies takes, then exit")
+    parser.add_argument(
+        "--trace", metavar="PATH",
+        help="write the spans of the run as Chrome trace events (chrome://tracing, Perfetto)")
+    parser.add_argument(
+        "--trace-csv", metavar="PATH",
+        help="write the spans of the run as CSV, one row per span")
+    parser.add_argument(
+        "--repeat", type=int, default=1,
+        help="run every test case N times and report min/p50/p95/max per phase (default: 1)")
+    parser.add_argument(
+        "--results", metavar="PATH",
+        help="save the aggregated phase statistics of this run as JSON")
+    parser.add_argument(
+        "--baseline", metavar="PATH",
+        help="compare phase medians with this JSON file of results, or create it when missing")
+    parser.add_argument(
+        "--regression-threshold", type=float, default=0.2,
+        help="relative growth of a median that counts as a regression (default: 0.2)")
+    parser.add_argument(
+        "--regression-min-seconds", type=float, default=1.0,
+        help="ignore median growth below this many seconds (default: 1.0)")
+    return parser.parse_args(args)
+
+
+def uses_object_storage(case):
+    return "create_object_storage_instance" in inspect.unwrap(case).__code__.co_names
+
+
+def run_case(case):
+    resource_group_name =  '{}{}{}'.format(vendor.PREFIX, case.__name__, vendor._random_string(20))
+    # Only the groups of cases using object storage get a storage account ahead.
+    preprovision_storage = vendor.STORAGE_PREPROVISION and uses_object_storage(case)
+    with vendor._deploy_resource_group(resource_group_name, vendor.RESOURCE_GROUP_LOCATION, preprovision_storage):
+        case(resource_group_name)
+
+
+def run_case_buffered(case):
+    """Run `case`, returning what it printed and the exception it raised, if any."""
+    with buffered_output() as output:
+        try:
+            run_case(case)
+        except Exception as ex:
+            return output.getvalue(), ex
+    return output.getvalue(), None
+
+
+def run_cases(cases, jobs):
+    if jobs <= 1:
+        for case in cases:
+            run_case(case)
+            print("")
+        return
+
+    # Every case is printed before the first error is raised again.
+    errors = []
+    with ThreadPoolExecutor(max_workers=jobs, thread_name_prefix="case") as executor:
+        futures = [executor.submit(run_case_buffered, case) for case in cases]
+        for future in as_completed(futures):
+            output, error = future.result()
+            print(output)
+            if error is not None:
+                errors.append(error)
+    if errors:
+        raise errors[0]
+
+
+def select_cases(cases, names):
+    if not names:
+        return list(cases)
+    return [case for case in cases if any(name in case.__name__ for name in names)]
+
+
 def main(*args):
+    options = parse_args(args)
+
+    if options.profile_import:
+        import import_profile
+        import_profile.report(import_profile.profile("import main"))
+        return 0
 
     for helper in [
         vendor.create_compute_instance,
+        vendor.create_compute_instances,
         vendor.create_object_storage_instance,
         vendor.create_block_storage_instance,
         vendor.create_relational_database_instance,
@@ -66,15 +163,81 @@ def main(*args):
 
 
     with test_environment():
-        print("")
-        for case in test.all_tests:
-            resource_group_name =  '{}{}{}'.format(vendor.PREFIX, case.__name__, vendor._random_string(20))
-            with vendor._deploy_resource_group(resource_group_name, vendor.RESOURCE_GROUP_LOCATION):
-                case(resource_group_name)
+        for iteration in range(options.repeat):
             print("")
+            if options.repeat > 1:
+                print(Fore.WHITE + Style.BRIGHT + "Run {} of {}".format(iteration + 1, options.repeat) + Style.RESET_ALL)
+            run_cases(select_cases(test.all_tests, options.cases), options.jobs)
     print(Fore.GREEN + Style.BRIGHT + "\nRun complete. Metrics:" + Style.RESET_ALL)
-    metrics.output()
+    if options.repeat > 1:
+        metrics.output_summary()
+    else:
+        metrics.output()
+    output_deletions(*vendor.resource_group_deletions())
+
+    if options.trace:
+        metrics.write_chrome_trace(options.trace)
+        print("Trace written to {}".format(options.trace))
+    if options.trace_csv:
+        metrics.write_csv(options.trace_csv)
+        print("Span CSV written to {}".format(options.trace_csv))
+
+    summary = metrics.summary()
+    if options.results:
+        save_results(options.results, summary, options.repeat)
+        print("Results written to {}".format(options.results))
+    if options.baseline:
+        return check_baseline(options, summary)
+    return 0
+
+
+def output_deletions(completed, pending):
+    """Print how long every resource group took to delete, slowest first."""
+    deletions = completed + pending
+    if not deletions:
+        return
+    print("")
+    print(Fore.WHITE + Style.BRIGHT + "resource_group_deletions" + Style.RESET_ALL)
+    prefix = iter((["├"] * (len(deletions)-1)) + ["└"])
+    for deletion in completed:
+        if deletion.error is None:
+            print(" {} {} deleted {:0.2f}s".format(next(prefix), deletion.name, deletion.latency))
+        else:
+            print(Fore.RED + " {} {} failed after {:0.2f}s: {}".format(
+                next(prefix), deletion.name, deletion.latency, deletion.error) + Fore.RESET)
+    for deletion in pending:
+        print(Fore.YELLOW + " {} {} still deleting after {:0.2f}s".format(
+            next(prefix), deletion.name, deletion.latency) + Fore.RESET)
+
+
+def save_results(path, summary, repeat):
+    with open(path, "w") as f:
+        json.dump({"repeat": repeat, "phases": summary}, f, indent=2, sort_keys=True)
+
+
+def check_baseline(options, summary):
+    """Compare `summary` with the baseline file; returns the exit status of the run."""
+    if not os.path.exists(options.baseline):
+        save_results(options.baseline, summary, options.repeat)
+        print("No baseline at {}, saved this run as the baseline".format(options.baseline))
+        return 0
+
+    with open(options.baseline) as f:
+        baseline = json.load(f)["phases"]
+
+    regressions = find_regressions(
+        summary, baseline, options.regression_threshold, options.regression_min_seconds)
+    if not regressions:
+        print(Fore.GREEN + "No phase median regressed against {}".format(options.baseline) + Fore.RESET)
+        return 0
+
+    print(Fore.RED + Style.BRIGHT + "\nRegressions against {}:".format(options.baseline) + Style.RESET_ALL)
+    for (caller, name, phase, baseline_p50, p50) in regressions:
+        print(Fore.RED + " {} / {} {}: p50 {:0.2f}s -> {:0.2f}s (+{:0.0%})".format(
+            caller, name, phase, baseline_p50, p50, p50 / baseline_p50 - 1 if baseline_p50 else float("inf"))
+            + Style.RESET_ALL)
+    return 1
 
 
 if __name__ == "__main__":
-    main(*sys.argv[1:])
+    sys.exit(main(*sys.argv[1:]))
@@ -0,0 +1,872 @@
+# encoding: utf-8
+
+"""
+Local stand-in for Azure, selected with `BACKEND=offline`.
+
+It benchmarks the harness itself: SSH and SFTP handling, SQLAlchemy setup,
+metrics and orchestration, without a subscription and without the noise of
+the control plane.
+
+- Management clients for resource groups, networks, compute, storage and
+  MySQL answer with objects shaped like the SDK models. Their long-running
+  operations complete after an injected latency.
+- Every VM is a directory on the host served by its own paramiko SSH and
+  SFTP server on 127.0.0.1. Commands run with bash in the home directory of
+  that VM. Tools that need root, such as `mount` or `mkfs.ext4`, are replaced
+  by the shell scripts in `resources/offline`.
+- Managed disks are directories. Attaching one links it at
+  `/dev/disk/azure/scsi1/lun<N>` of the VM, and mounting links the mount
+  point to its contents.
+- Blobs are files in a directory per storage account.
+- MySQL servers are SQLite files, or databases on a local MySQL server.
+"""
+
+import os
+import posixpath
+import random
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+from json import dump, load
+from logging import getLogger
+from pathlib import Path
+from time import monotonic, sleep
+from types import SimpleNamespace
+from urllib.parse import quote, unquote
+from uuid import uuid4
+
+import paramiko
+from azure.common import AzureHttpError, AzureMissingResourceHttpError
+
+LOG = getLogger('vendor.offline_backend')
+
+# Transports of the emulated SSH servers log here. The servers are not under
+# test, so their errors, such as clients resetting connections they are done
+# with, stay out of the output.
+SSHD_LOG_CHANNEL = 'vendor.offline_backend.sshd'
+getLogger(SSHD_LOG_CHANNEL).setLevel('CRITICAL')
+
+SHIMS = Path(__file__).resolve().parent / 'resources' / 'offline'
+SUBSCRIPTION_ID = '00000000-0000-0000-0000-000000000000'
+HOST = '127.0.0.1'
+READ_SIZE = 32768
+BANNER_TIMEOUT_SECONDS = 30
+
+
+class Latency(object):
+    """
+    :param lro_seconds: mean duration of long-running operations.
+    :param call_seconds: duration of every other management call.
+    :param jitter: relative spread of the durations, 0.2 for +/- 20%.
+    """
+
+    def __init__(self, lro_seconds=0.5, call_seconds=0.05, jitter=0.2):
+        self.lro_seconds = lro_seconds
+        self.call_seconds = call_seconds
+        self.jitter = jitter
+
+    def lro(self):
+        return self._spread(self.lro_seconds)
+
+    def call(self):
+        sleep(self._spread(self.call_seconds))
+
+    def _spread(self, seconds):
+        return random.uniform(seconds * (1 - self.jitter), seconds * (1 + self.jitter))  # nosec
+
+
+class Poller(object):
+    """`LROPoller` look-alike whose operation already ran, completing after `delay`."""
+
+    def __init__(self, operation, delay):
+        self._ready_at = monotonic() + delay
+        try:
+            self._result, self._error = operation(), None
+        except Exception as ex:
+            self._result, self._error = None, ex
+
+    def done(self):
+        return monotonic() >= self._ready_at
+
+    def wait(self, timeout=None):
+        remaining = self._ready_at - monotonic()
+        if remaining > 0:
+            sleep(remaining if timeout is None else min(remaining, timeout))
+
+    def result(self, timeout=None):
+        self.wait(timeout)
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+class OfflineCloud(object):
+    """
+    State of the offline backend, kept in a temporary directory.
+
+    :param directory: parent directory of that temporary directory.
+    :param latency: :class:`Latency` injected into management calls.
+    :param mysql_host: local MySQL server to create databases on, SQLite
+                       files are used when empty.
+    :param mysql_port: port of that server.
+    """
+
+    def __init__(self, directory=None, latency=None, mysql_host='', mysql_port=3306):
+        self.root = Path(tempfile.mkdtemp(prefix='offline-cloud-', dir=directory or None))
+        self.latency = latency or Latency()
+        self.mysql_host = mysql_host
+        self.mysql_port = mysql_port
+        self._lock = threading.Lock()
+        self._host_key = None
+        self._vms = {}
+        self._disks = {}
+        self._accounts = {}
+        self._servers = {}
+        self._clients = {
+            'resource': SimpleNamespace(resource_groups=_ResourceGroups(self)),
+            'network': _NetworkClient(self),
+            'compute': SimpleNamespace(virtual_machines=_VirtualMachines(self), disks=_Disks(self)),
+            'storage': SimpleNamespace(storage_accounts=_StorageAccounts(self)),
+            'mysql': SimpleNamespace(
+                servers=_MySQLServers(self),
+                firewall_rules=_MySQLFirewallRules(self),
+                databases=_MySQLDatabases(self),
+            ),
+        }
+        LOG.info('Offline cloud in %s', self.root)
+
+    def client(self, client_type):
+        """Return the management client named `client_type`, as in `vendor._CLIENT_TYPES`."""
+        return self._clients[client_type]
+
+    def blob_service(self, account_name, account_key):
+        with self._lock:
+            account = self._accounts.get(account_name)
+        if account is None or account.key != account_key:
+            raise AzureHttpError('Server failed to authenticate the request', 403)
+        return DirectoryBlobService(account.directory, account_name)
+
+    def ssh_port(self, vm_name):
+        return self._vm(None, vm_name).port
+
+    def database_connection(self, server_name, database_name):
+        """Connection fields of a `vendor.MysqlHandle` for a database created here."""
+        with self._lock:
+            server = self._servers[server_name]
+        if not self.mysql_host:
+            return dict(
+                user='',
+                password='',
+                host='',
+                port=None,
+                database=str(server.directory / '{}.sqlite'.format(database_name)),
+                connect_args={'check_same_thread': False},
+                connector='sqlite',
+            )
+        return dict(
+            user=server.login,
+            password=server.password,
+            host=self.mysql_host,
+            port=self.mysql_port,
+            database=database_name,
+            connect_args={},
+            connector='mysql+pymysql',
+        )
+
+    def close(self):
+        with self._lock:
+            vms = list(self._vms.values())
+            self._vms.clear()
+        for vm in vms:
+            vm.stop()
+        shutil.rmtree(str(self.root), ignore_errors=True)
+
+    # Helpers of the fake management clients.
+
+    def host_key(self):
+        with self._lock:
+            if self._host_key is None:
+                self._host_key = paramiko.RSAKey.generate(2048)
+            return self._host_key
+
+    def group_directory(self, resource_group_name):
+        directory = self.root / resource_group_name.lower()
+        if not directory.is_dir():
+            raise AzureMissingResourceHttpError('Resource group {} not found'.format(resource_group_name), 404)
+        return directory
+
+    def add_vm(self, vm):
+        with self._lock:
+            self._vms[vm.name.lower()] = vm
+
+    def _vm(self, resource_group_name, vm_name):
+        with self._lock:
+            vm = self._vms.get(vm_name.lower())
+        if vm is None or (resource_group_name and vm.resource_group.lower() != resource_group_name.lower()):
+            raise AzureMissingResourceHttpError('Virtual machine {} not found'.format(vm_name), 404)
+        return vm
+
+    def delete_group(self, resource_group_name):
+        with self._lock:
+            vms = [vm for vm in self._vms.values() if vm.resource_group.lower() == resource_group_name.lower()]
+            for vm in vms:
+                del self._vms[vm.name.lower()]
+        for vm in vms:
+            vm.stop()
+        shutil.rmtree(str(self.root / resource_group_name.lower()), ignore_errors=True)
+
+
+def _resource_id(resource_group_name, provider, kind, name):
+    return '/subscriptions/{}/resourceGroups/{}/providers/{}/{}/{}'.format(
+        SUBSCRIPTION_ID, resource_group_name, provider, kind, name)
+
+
+def _get(parameters, name, default=None):
+    """Read `name` from SDK models and plain dicts alike."""
+    if isinstance(parameters, dict):
+        return parameters.get(name, default)
+    return getattr(parameters, name, default)
+
+
+class _Operations(object):
+    def __init__(self, cloud):
+        self._cloud = cloud
+
+    def _poller(self, operation):
+        return Poller(operation, self._cloud.latency.lro())
+
+
+class _ResourceGroups(_Operations):
+    def create_or_update(self, resource_group_name, parameters):
+        self._cloud.latency.call()
+        (self._cloud.root / resource_group_name.lower()).mkdir(exist_ok=True)
+        return SimpleNamespace(name=resource_group_name, location=_get(parameters, 'location'))
+
+    def delete(self, resource_group_name):
+        return self._poller(lambda: self._cloud.delete_group(resource_group_name))
+
+
+class _NetworkClient(_Operations):
+    """Network resources only need ids, and every public IP is the loopback address."""
+
+    def __init__(self, cloud):
+        super(_NetworkClient, self).__init__(cloud)
+        self.virtual_networks = _NetworkResources(cloud, 'virtualNetworks')
+        self.public_ip_addresses = _NetworkResources(cloud, 'publicIPAddresses')
+        self.network_security_groups = _NetworkResources(cloud, 'networkSecurityGroups')
+        self.network_interfaces = _NetworkResources(cloud, 'networkInterfaces')
+
+
+class _NetworkResources(_Operations):
+    def __init__(self, cloud, kind):
+        super(_NetworkResources, self).__init__(cloud)
+        self._kind = kind
+
+    def create_or_update(self, resource_group_name, name, parameters):
+        def create():
+            self._cloud.group_directory(resource_group_name)
+            resource_id = _resource_id(resource_group_name, 'Microsoft.Network', self._kind, name)
+            subnets = [
+                SimpleNamespace(name=_get(subnet, 'name'), id='{}/subnets/{}'.format(resource_id, _get(subnet, 'name')))
+                for subnet in _get(parameters, 'subnets', [])
+            ]
+            return SimpleNamespace(name=name, id=resource_id, subnets=subnets, ip_address=HOST)
+        return self._poller(create)
+
+
+class _Disks(_Operations):
+    def create_or_update(self, resource_group_name, disk_name, parameters):
+        def create():
+            directory = self._cloud.group_directory(resource_group_name) / 'disks' / disk_name
+            directory.mkdir(parents=True)
+            return SimpleNamespace(
+                name=disk_name,
+                id=_resource_id(resource_group_name, 'Microsoft.Compute', 'disks', disk_name),
+                disk_size_gb=_get(parameters, 'disk_size_gb'),
+            )
+        return self._poller(create)
+
+
+class _VirtualMachines(_Operations):
+    def get(self, resource_group_name, vm_name):
+        self._cloud.latency.call()
+        return self._cloud._vm(resource_group_name, vm_name).model()
+
+    def create_or_update(self, resource_group_name, vm_name, parameters):
+        def create_or_update():
+            try:
+                vm = self._cloud._vm(resource_group_name, vm_name)
+            except AzureMissingResourceHttpError:
+                vm = _Vm.create(self._cloud, resource_group_name, vm_name, parameters)
+                self._cloud.add_vm(vm)
+            else:
+                vm.attach(_get(_get(parameters, 'storage_profile'), 'data_disks', []))
+            return vm.model()
+        return self._poller(create_or_update)
+
+    def run_command(self, resource_group_name, vm_name, parameters):
+        def run():
+            vm = self._cloud._vm(resource_group_name, vm_name)
+            completed = subprocess.run(
+                ['bash', '-s'],
+                input='\n'.join(_get(parameters, 'script')) + '\n',
+                cwd=str(vm.home),
+                env=vm.environment(),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                universal_newlines=True,
+            )
+            return SimpleNamespace(value=[SimpleNamespace(code='ProvisioningState/succeeded', message=completed.stdout)])
+        return self._poller(run)
+
+
+class _StorageAccounts(_Operations):
+    def create(self, resource_group_name, account_name, parameters):
+        def create():
+            directory = self._cloud.group_directory(resource_group_name) / 'storage' / account_name
+            directory.mkdir(parents=True)
+            with self._cloud._lock:
+                self._cloud._accounts[account_name] = SimpleNamespace(directory=directory, key=uuid4().hex)
+            return SimpleNamespace(name=account_name, location=_get(parameters, 'location'))
+        return self._poller(create)
+
+    def list_keys(self, resource_group_name, account_name):
+        self._cloud.latency.call()
+        with self._cloud._lock:
+            account = self._cloud._accounts[account_name]
+        return SimpleNamespace(keys=[SimpleNamespace(key_name='key1', value=account.key)])
+
+
+class _MySQLServers(_Operations):
+    def create(self, resource_group_name, server_name, parameters):
+        def create():
+            properties = _get(parameters, 'properties')
+            directory = self._cloud.group_directory(resource_group_name) / 'mysql' / server_name
+            directory.mkdir(parents=True)
+            with self._cloud._lock:
+                self._cloud._servers[server_name] = SimpleNamespace(
+                    directory=directory,
+                    login=_get(properties, 'administrator_login'),
+                    password=_get(properties, 'administrator_login_password'),
+                )
+            return SimpleNamespace(
+                name=server_name,
+                fully_qualified_domain_name=self._cloud.mysql_host or 'localhost',
+            )
+        return self._poller(create)
+
+
+class _MySQLFirewallRules(_Operations):
+    def create_or_update(self, resource_group_name, server_name, firewall_rule_name, start_ip_address, end_ip_address):
+        return self._poller(lambda: SimpleNamespace(name=firewall_rule_name))
+
+
+class _MySQLDatabases(_Operations):
+    def create_or_update(self, resource_group_name, server_name, database_name, charset=None, collation=None):
+        def create():
+            if self._cloud.mysql_host:
+                _create_mysql_database(self._cloud, server_name, database_name)
+            return SimpleNamespace(name=database_name, charset=charset, collation=collation)
+        return self._poller(create)
+
+
+def _create_mysql_database(cloud, server_name, database_name):
+    import pymysql
+
+    with cloud._lock:
+        server = cloud._servers[server_name]
+    connection = pymysql.connect(host=cloud.mysql_host, port=cloud.mysql_port, user=server.login, password=server.password)
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('CREATE DATABASE IF NOT EXISTS `{}`'.format(database_name))
+    finally:
+        connection.close()
+
+
+class _Vm(object):
+    """A VM: a directory tree with a home directory, served over SSH."""
+
+    def __init__(self, cloud, resource_group_name, name, username, authorized_keys, location):
+        self.cloud = cloud
+        self.resource_group = resource_group_name
+        self.name = name
+        self.username = username
+        self.authorized_keys = authorized_keys
+        self.location = location
+        self.root = cloud.group_directory(resource_group_name) / 'vms' / name
+        self.home = self.root / 'home' / username
+        self.devices = self.root / 'dev' / 'disk' / 'azure' / 'scsi1'
+        # One file per open SFTP handle, holding the path it opened, so the
+        # umount and fuser shims can tell a busy mount point.
+        self.open_files = self.root / 'proc' / 'open-files'
+        self.data_disks = []
+        self._socket = None
+        self._transports = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def create(cls, cloud, resource_group_name, name, parameters):
+        os_profile = _get(parameters, 'os_profile')
+        ssh = _get(_get(os_profile, 'linux_configuration'), 'ssh')
+        vm = cls(
+            cloud,
+            resource_group_name,
+            name,
+            username=_get(os_profile, 'admin_username'),
+            authorized_keys={_key_data(_get(key, 'key_data')) for key in _get(ssh, 'public_keys', [])},
+            location=_get(parameters, 'location'),
+        )
+        vm.home.mkdir(parents=True)
+        vm.devices.mkdir(parents=True)
+        vm.open_files.mkdir(parents=True)
+        vm.start()
+        return vm
+
+    @property
+    def port(self):
+        return self._socket.getsockname()[1]
+
+    def model(self):
+        return SimpleNamespace(
+            name=self.name,
+            id=_resource_id(self.resource_group, 'Microsoft.Compute', 'virtualMachines', self.name),
+            location=self.location,
+            storage_profile=SimpleNamespace(data_disks=list(self.data_disks)),
+        )
+
+    def environment(self):
+        environment = dict(os.environ)
+        environment.update(
+            HOME=str(self.home),
+            USER=self.username,
+            ROOT=str(self.root),
+            PATH=os.pathsep.join([str(SHIMS), environment.get('PATH', os.defpath)]),
+        )
+        return environment
+
+    def attach(self, data_disks):
+        """
+        Link every data disk at its LUN, replacing the previous links. A disk
+        with files still open through SFTP cannot be detached: on Azure its
+        filesystem would be corrupted.
+        """
+        targets = {}
+        for data_disk in data_disks:
+            disk_id = data_disk.managed_disk.id
+            group, name = disk_id.split('/')[4], disk_id.split('/')[-1]
+            targets[data_disk.lun] = self.cloud.group_directory(group) / 'disks' / name
+
+        kept = {os.path.realpath(str(target)) for target in targets.values()}
+        for link in self.devices.iterdir():
+            disk = os.path.realpath(str(link))
+            if disk not in kept and self._has_open_files(disk):
+                raise AzureHttpError('Disk {} is detached while files on it are open'.format(os.path.basename(disk)), 409)
+
+        for link in self.devices.iterdir():
+            link.unlink()
+        for lun, target in targets.items():
+            (self.devices / 'lun{}'.format(lun)).symlink_to(target, target_is_directory=True)
+        self.data_disks = list(data_disks)
+
+    def _has_open_files(self, directory):
+        for registration in self.open_files.iterdir():
+            try:
+                path = registration.read_text()
+            except FileNotFoundError:
+                continue
+            if path == directory or path.startswith(directory + os.sep):
+                return True
+        return False
+
+    def start(self):
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((HOST, 0))
+        self._socket.listen(16)
+        threading.Thread(target=self._accept_loop, name='ssh-{}'.format(self.name), daemon=True).start()
+
+    def stop(self):
+        self._socket.close()
+        with self._lock:
+            transports, self._transports = self._transports, []
+        for transport in transports:
+            transport.close()
+
+    def _accept_loop(self):
+        while True:
+            try:
+                connection, _ = self._socket.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(connection,), name='ssh-{}'.format(self.name), daemon=True).start()
+
+    def _serve(self, connection):
+        # Readiness checks connect and close without a word; only start a
+        # transport once the client sent its banner.
+        try:
+            connection.settimeout(BANNER_TIMEOUT_SECONDS)
+            if not connection.recv(1, socket.MSG_PEEK):
+                connection.close()
+                return
+            connection.settimeout(None)
+        except OSError:
+            connection.close()
+            return
+
+        transport = paramiko.Transport(connection)
+        transport.set_log_channel(SSHD_LOG_CHANNEL)
+        transport.add_server_key(self.cloud.host_key())
+        transport.set_subsystem_handler('sftp', paramiko.SFTPServer, _RootedSFTPServer, self)
+        with self._lock:
+            self._transports.append(transport)
+        try:
+            transport.start_server(server=_SSHServer(self))
+        except (paramiko.SSHException, EOFError) as ex:
+            LOG.debug('SSH negotiation with %s failed: %s', self.name, ex)
+
+
+def _key_data(public_key):
+    """The base64 part of an OpenSSH public key line."""
+    parts = public_key.split()
+    return parts[1] if len(parts) > 1 else parts[0]
+
+
+class _SSHServer(paramiko.ServerInterface):
+    def __init__(self, vm):
+        self.vm = vm
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_auth_publickey(self, username, key):
+        if username == self.vm.username and key.get_base64() in self.vm.authorized_keys:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=self._exec, args=(channel, command.decode()), name='exec-{}'.format(self.vm.name), daemon=True).start()
+        return True
+
+    def _exec(self, channel, command):
+        try:
+            process = subprocess.Popen(
+                ['bash', '-c', command],
+                cwd=str(self.vm.home),
+                env=self.vm.environment(),
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+            threading.Thread(target=_pump_stdin, args=(channel, process.stdin), daemon=True).start()
+            pumps = [
+                threading.Thread(target=_pump_output, args=(process.stdout, channel.sendall)),
+                threading.Thread(target=_pump_output, args=(process.stderr, channel.sendall_stderr)),
+            ]
+            for pump in pumps:
+                pump.start()
+            for pump in pumps:
+                pump.join()
+            channel.send_exit_status(process.wait())
+        except Exception as ex:
+            LOG.warning('Command on %s failed: %s', self.vm.name, ex)
+            channel.send_exit_status(255)
+        finally:
+            channel.close()
+
+
+def _pump_stdin(channel, stdin):
+    try:
+        while True:
+            data = channel.recv(READ_SIZE)
+            if not data:
+                break
+            stdin.write(data)
+            stdin.flush()
+    except (OSError, EOFError):
+        pass
+    finally:
+        try:
+            stdin.close()
+        except OSError:
+            pass
+
+
+def _pump_output(stream, send):
+    try:
+        for data in iter(lambda: stream.read1(READ_SIZE), b''):
+            send(data)
+    except (OSError, EOFError):
+        pass
+
+
+class _RootedSFTPServer(paramiko.SFTPServerInterface):
+    """SFTP on the directory tree of a VM; relative paths start in its home."""
+
+    def __init__(self, server, vm, *args, **kwargs):
+        super(_RootedSFTPServer, self).__init__(server, *args, **kwargs)
+        self.vm = vm
+        self.home = '/home/{}'.format(vm.username)
+
+    def canonicalize(self, path):
+        return posixpath.normpath(posixpath.join(self.home, path))
+
+    def _local(self, path):
+        return os.path.join(str(self.vm.root), self.canonicalize(path).lstrip('/'))
+
+    def list_folder(self, path):
+        local = self._local(path)
+        try:
+            return [
+                paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(local, name)), name)
+                for name in os.listdir(local)
+            ]
+        except OSError as ex:
+            return paramiko.SFTPServer.convert_errno(ex.errno)
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self._local(path)))
+        except OSError as ex:
+            return paramiko.SFTPServer.convert_errno(ex.errno)
+
+    def lstat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.lstat(self._local(path)))
+        except OSError as ex:
+            return paramiko.SFTPServer.convert_errno(ex.errno)
+
+    def open(self, path, flags, attr):
+        local = self._local(path)
+        try:
+            mode = getattr(attr, 'st_mode', None)
+            fd = os.open(local, flags | getattr(os, 'O_BINARY', 0), mode if mode is not None else 0o666)
+        except OSError as ex:
+            return paramiko.SFTPServer.convert_errno(ex.errno)
+
+        if flags & os.O_WRONLY:
+            fmode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            fmode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            fmode = 'rb'
+        handle = _SFTPHandle(self.vm, local, flags)
+        handle.readfile = handle.writefile = os.fdopen(fd, fmode)
+        return handle
+
+    def remove(self, path):
+        return self._call(os.remove, self._local(path))
+
+    def rename(self, oldpath, newpath):
+        return self._call(os.rename, self._local(oldpath), self._local(newpath))
+
+    def posix_rename(self, oldpath, newpath):
+        return self._call(os.replace, self._local(oldpath), self._local(newpath))
+
+    def mkdir(self, path, attr):
+        return self._call(os.mkdir, self._local(path))
+
+    def rmdir(self, path):
+        return self._call(os.rmdir, self._local(path))
+
+    def chattr(self, path, attr):
+        return self._call(paramiko.SFTPServer.set_file_attr, self._local(path), attr)
+
+    def readlink(self, path):
+        try:
+            return os.readlink(self._local(path))
+        except OSError as ex:
+            return paramiko.SFTPServer.convert_errno(ex.errno)
+
+    def symlink(self, target_path, path):
+        return self._call(os.symlink, target_path, self._local(path))
+
+    @staticmethod
+    def _call(function, *args):
+        try:
+            function(*args)
+        except OSError as ex:
+            return paramiko.SFTPServer.convert_errno(ex.errno)
+        return paramiko.SFTP_OK
+
+
+class _SFTPHandle(paramiko.SFTPHandle):
+    """
+    Open file of an SFTP session, registered with its VM until closed. The
+    fuser shim kills a handle by removing its registration, after which it
+    fails every read and write.
+    """
+
+    def __init__(self, vm, filename, flags):
+        super(_SFTPHandle, self).__init__(flags)
+        self.filename = filename
+        self._registration = vm.open_files / uuid4().hex
+        self._registration.write_text(os.path.realpath(filename))
+
+    def close(self):
+        try:
+            self._registration.unlink()
+        except FileNotFoundError:
+            pass
+        super(_SFTPHandle, self).close()
+
+    def read(self, offset, length):
+        if not self._registration.exists():
+            return paramiko.SFTP_FAILURE
+        return super(_SFTPHandle, self).read(offset, length)
+
+    def write(self, offset, data):
+        if not self._registration.exists():
+            return paramiko.SFTP_FAILURE
+        return super(_SFTPHandle, self).write(offset, data)
+
+    def stat(self):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as ex:
+            return paramiko.SFTPServer.convert_errno(ex.errno)
+
+    def chattr(self, attr):
+        try:
+            paramiko.SFTPServer.set_file_attr(self.filename, attr)
+            return paramiko.SFTP_OK
+        except OSError as ex:
+            return paramiko.SFTPServer.convert_errno(ex.errno)
+
+
+class DirectoryBlobService(object):
+    """
+    The subset of `BlockBlobService` used by the harness, storing every
+    container as a directory: blob contents in `data/`, their properties and
+    metadata in `meta/` and uncommitted blocks in `blocks/`.
+    """
+
+    def __init__(self, directory, account_name):
+        self.directory = Path(directory)
+        self.account_name = account_name
+        self._lock = threading.Lock()
+
+    def create_container(self, container_name, fail_on_exist=False, **kwargs):
+        container = self.directory / container_name
+        if container.exists():
+            if fail_on_exist:
+                raise AzureHttpError('The specified container already exists.', 409)
+            return False
+        for part in ('data', 'meta', 'blocks'):
+            (container / part).mkdir(parents=True)
+        return True
+
+    def create_blob_from_bytes(self, container_name, blob_name, blob, metadata=None, validate_content=False, **kwargs):
+        self._commit(container_name, blob_name, [bytes(blob)], metadata)
+
+    def put_block(self, container_name, blob_name, block, block_id, validate_content=False, **kwargs):
+        blocks = self._path(container_name, 'blocks', blob_name)
+        blocks.mkdir(exist_ok=True)
+        _write_atomically(blocks / quote(block_id, safe=''), [bytes(block)])
+
+    def put_block_list(self, container_name, blob_name, block_list, metadata=None, **kwargs):
+        blocks = self._path(container_name, 'blocks', blob_name)
+        try:
+            chunks = [(blocks / quote(block.id, safe='')).read_bytes() for block in block_list]
+        except FileNotFoundError:
+            raise AzureHttpError('The specified block list is invalid.', 400)
+        self._commit(container_name, blob_name, chunks, metadata)
+        shutil.rmtree(str(blocks), ignore_errors=True)
+
+    def get_blob_properties(self, container_name, blob_name, **kwargs):
+        with self._lock:
+            return self._blob(container_name, blob_name, content=False)
+
+    def get_blob_to_bytes(self, container_name, blob_name, validate_content=False,
+                          if_match=None, if_none_match=None, **kwargs):
+        with self._lock:
+            blob = self._blob(container_name, blob_name, content=False)
+            _check_conditions(blob, if_match, if_none_match)
+            blob.content = self._path(container_name, 'data', blob_name).read_bytes()
+        return blob
+
+    def get_blob_to_stream(self, container_name, blob_name, stream, start_range=None, end_range=None,
+                           validate_content=False, if_match=None, if_none_match=None, **kwargs):
+        with self._lock:
+            blob = self._blob(container_name, blob_name, content=False)
+            _check_conditions(blob, if_match, if_none_match)
+            with open(str(self._path(container_name, 'data', blob_name)), 'rb') as f:
+                start = start_range or 0
+                end = blob.properties.content_length - 1 if end_range is None else end_range
+                f.seek(start)
+                stream.write(f.read(end - start + 1))
+        return blob
+
+    def delete_blob(self, container_name, blob_name, **kwargs):
+        with self._lock:
+            try:
+                self._path(container_name, 'data', blob_name).unlink()
+            except FileNotFoundError:
+                raise AzureMissingResourceHttpError('The specified blob does not exist.', 404)
+            self._path(container_name, 'meta', blob_name).unlink()
+
+    def list_blobs(self, container_name, prefix=None, num_results=None, marker=None, **kwargs):
+        with self._lock:
+            names = sorted(unquote(name) for name in os.listdir(str(self.directory / container_name / 'data')))
+            names = [name for name in names if not prefix or name.startswith(prefix)]
+            if marker:
+                names = [name for name in names if name >= marker]
+            page = _BlobPage(self._blob(container_name, name, content=False) for name in names[:num_results])
+        page.next_marker = names[num_results] if num_results and len(names) > num_results else None
+        return page
+
+    def _path(self, container_name, part, blob_name):
+        container = self.directory / container_name
+        if not container.is_dir():
+            raise AzureMissingResourceHttpError('The specified container does not exist.', 404)
+        return container / part / quote(blob_name, safe='')
+
+    def _commit(self, container_name, blob_name, chunks, metadata):
+        data = self._path(container_name, 'data', blob_name)
+        properties = {
+            'etag': '"{}"'.format(uuid4().hex),
+            'content_length': sum(len(chunk) for chunk in chunks),
+            'metadata': metadata or {},
+        }
+        with self._lock:
+            _write_atomically(data, chunks)
+            with open(str(self._path(container_name, 'meta', blob_name)), 'w') as f:
+                dump(properties, f)
+
+    def _blob(self, container_name, blob_name, content):
+        try:
+            with open(str(self._path(container_name, 'meta', blob_name))) as f:
+                properties = load(f)
+        except FileNotFoundError:
+            raise AzureMissingResourceHttpError('The specified blob does not exist.', 404)
+        return SimpleNamespace(
+            name=blob_name,
+            content=None,
+            metadata=properties['metadata'],
+            properties=SimpleNamespace(etag=properties['etag'], content_length=properties['content_length']),
+        )
+
+
+class _BlobPage(list):
+    next_marker = None
+
+
+def _check_conditions(blob, if_match, if_none_match):
+    if if_match is not None and if_match != blob.properties.etag:
+        raise AzureHttpError('The condition specified using HTTP conditional header(s) is not met.', 412)
+    if if_none_match is not None and if_none_match == blob.properties.etag:
+        raise AzureHttpError('Not Modified', 304)
+
+
+def _write_atomically(path, chunks):
+    fd, temporary = tempfile.mkstemp(dir=str(path.parent))
+    with os.fdopen(fd, 'wb') as f:
+        for chunk in chunks:
+            f.write(chunk)
+    os.replace(temporary, str(path))
@@ -0,0 +1,169 @@
+# encoding: utf-8
+
+"""
+Readiness probes with hard deadlines.
+
+Port probes use non-blocking connects multiplexed through `selectors`, so any
+number of host:port targets are watched at once and a target is reported the
+moment its connect completes. Failed attempts are retried with exponential
+backoff and full jitter instead of a fixed sleep.
+"""
+
+import errno
+import random
+import selectors
+import socket
+from logging import getLogger
+from time import monotonic, sleep
+
+LOG = getLogger('vendor.readiness')
+
+
+class NotReady(Exception):
+    pass
+
+
+class Backoff(object):
+    """Exponential backoff with full jitter."""
+
+    def __init__(self, initial=0.05, maximum=1.0, multiplier=2.0):
+        self.initial = initial
+        self.maximum = maximum
+        self.multiplier = multiplier
+
+    def delays(self):
+        ceiling = self.initial
+        while True:
+            yield random.uniform(0, ceiling)  # nosec
+            ceiling = min(ceiling * self.multiplier, self.maximum)
+
+
+class _PortProbe(object):
+    def __init__(self, host, port, backoff):
+        self.host = host
+        self.port = port
+        self.delays = backoff.delays()
+        self.sock = None
+        self.connect_started_at = None
+        self.next_attempt_at = 0
+        self.attempts = 0
+
+    @property
+    def target(self):
+        return '{}:{}'.format(self.host, self.port)
+
+    def connect(self, now):
+        """Start a non-blocking connect; returns True if it completed at once."""
+        self.attempts += 1
+        self.connect_started_at = now
+        try:
+            family, socktype, proto, _, address = socket.getaddrinfo(self.host, self.port, type=socket.SOCK_STREAM)[0]
+            self.sock = socket.socket(family, socktype, proto)
+            self.sock.setblocking(False)
+            result = self.sock.connect_ex(address)
+        except (OSError, socket.gaierror) as ex:
+            LOG.debug('Unable to probe %s: %s', self.target, ex)
+            self.retry(now)
+            return False
+
+        if result == 0:
+            return True
+        if result not in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+            LOG.debug('%s is not open: %s', self.target, errno.errorcode.get(result, result))
+            self.retry(now)
+        return False
+
+    def retry(self, now):
+        self.close()
+        self.next_attempt_at = now + next(self.delays)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+def wait_for_ports(targets, deadline_seconds, connect_timeout_seconds=1.0, backoff=None):
+    """
+    Wait until every `(host, port)` in `targets` accepts TCP connections.
+
+    :returns: a mapping of `(host, port)` to the seconds it took to become ready.
+    :raises NotReady: when a target is still closed after `deadline_seconds`.
+    """
+    backoff = backoff or Backoff()
+    started_at = monotonic()
+    deadline = started_at + deadline_seconds
+    waiting = [_PortProbe(host, port, backoff) for host, port in targets]
+    ready = {}
+
+    def mark_ready(probe, now):
+        probe.close()
+        waiting.remove(probe)
+        ready[(probe.host, probe.port)] = now - started_at
+        LOG.debug('%s ready after %.3fs (%d attempts)', probe.target, now - started_at, probe.attempts)
+
+    with selectors.DefaultSelector() as selector:
+        try:
+            while waiting:
+                now = monotonic()
+                if now >= deadline:
+                    raise NotReady('{} not available within {}s'.format(
+                        ', '.join(probe.target for probe in waiting), deadline_seconds))
+
+                for probe in list(waiting):
+                    if probe.sock is None and probe.next_attempt_at <= now:
+                        if probe.connect(now):
+                            mark_ready(probe, now)
+                        elif probe.sock is not None:
+                            selector.register(probe.sock, selectors.EVENT_WRITE, probe)
+                    elif probe.sock is not None and now - probe.connect_started_at > connect_timeout_seconds:
+                        selector.unregister(probe.sock)
+                        probe.retry(now)
+
+                wake_at = [deadline]
+                for probe in waiting:
+                    if probe.sock is None:
+                        wake_at.append(probe.next_attempt_at)
+                    else:
+                        wake_at.append(probe.connect_started_at + connect_timeout_seconds)
+
+                for key, _ in selector.select(max(min(wake_at) - monotonic(), 0)):
+                    probe = key.data
+                    selector.unregister(probe.sock)
+                    error = probe.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    now = monotonic()
+                    if error == 0:
+                        mark_ready(probe, now)
+                    else:
+                        LOG.debug('%s is not open: %s', probe.target, errno.errorcode.get(error, error))
+                        probe.retry(now)
+        finally:
+            for probe in waiting:
+                probe.close()
+
+    return ready
+
+
+def wait_until(check, name, deadline_seconds, errors=(Exception,), backoff=None):
+    """
+    Call `check` until it returns without raising one of `errors`.
+
+    :returns: the seconds it took for `check` to succeed.
+    :raises NotReady: when `check` still fails after `deadline_seconds`.
+    """
+    backoff = backoff or Backoff()
+    started_at = monotonic()
+    deadline = started_at + deadline_seconds
+
+    for attempt, delay in enumerate(backoff.delays(), start=1):
+        try:
+            check()
+        except errors as ex:
+            LOG.debug('%s not ready: %s', name, ex)
+            if monotonic() + delay >= deadline:
+                raise NotReady('{} not ready within {}s: {}'.format(name, deadline_seconds, ex))
+            sleep(delay)
+        else:
+            elapsed = monotonic() - started_at
+            LOG.debug('%s ready after %.3fs (%d attempts)', name, elapsed, attempt)
+            return elapsed
@@ -0,0 +1,61 @@
+# encoding: utf-8
+
+"""
+Process-wide registry of shared resources that are created once per key.
+
+The first caller for a key starts the creation in the background; concurrent
+callers get the same future and later callers get the completed one.
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+
+LOG = getLogger('vendor.registry')
+
+
+class FutureRegistry(object):
+    """
+    :param name: kind of resource, used in log messages and thread names.
+    :param max_workers: number of resources created at once; callers of
+                        further keys wait for a thread.
+    """
+
+    def __init__(self, name, max_workers):
+        self.name = name
+        self._lock = threading.Lock()
+        self._futures = {}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+
+    def submit(self, key, fn, *args, **kwargs):
+        """
+        Return the future for `key`, calling `fn(*args, **kwargs)` in the
+        background if there is none yet or the previous attempt failed.
+        """
+        with self._lock:
+            future = self._futures.get(key)
+            if future is not None and not _failed(future):
+                LOG.debug('Reusing %s for %s', self.name, key)
+                return future
+
+            LOG.debug('Creating %s for %s', self.name, key)
+            future = self._executor.submit(fn, *args, **kwargs)
+            self._futures[key] = future
+            return future
+
+    def get(self, key, fn, *args, **kwargs):
+        """Blocking version of :meth:`submit`."""
+        return self.submit(key, fn, *args, **kwargs).result()
+
+    def discard(self, predicate):
+        """
+        Forget every entry whose key matches `predicate`.
+
+        :returns: the futures of those entries, which may still be running.
+        """
+        with self._lock:
+            return [self._futures.pop(key) for key in [key for key in self._futures if predicate(key)]]
+
+
+def _failed(future):
+    return future.done() and (future.cancelled() or future.exception() is not None)
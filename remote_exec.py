@@ -0,0 +1,196 @@
+# encoding: utf-8
+
+"""
+Run shell scripts on compute instances.
+
+Two backends are available: SSH exec, which streams output as it is produced,
+and the ARM Run Command extension, which only needs the control plane but
+returns output once the script has finished. `select_backend` picks SSH
+whenever the instance accepts SSH connections.
+"""
+
+import re
+import select
+from collections import namedtuple
+from logging import getLogger
+from time import monotonic
+
+from readiness import NotReady, wait_for_ports
+from tests.metrics import metrics
+
+LOG = getLogger('vendor.remote_exec')
+
+SSH_PROBE_SECONDS = 2
+READ_SIZE = 32768
+# Printed after a script run through Run Command, which does not report the
+# exit status itself.
+EXIT_STATUS_MARKER = '__EXIT_STATUS:'
+EXIT_STATUS_LINE = re.compile(r'^{}(\d+)$'.format(re.escape(EXIT_STATUS_MARKER)))
+
+ExecResult = namedtuple('ExecResult', ['backend', 'exit_status', 'output', 'first_output_time', 'total_time'])
+
+
+class RemoteExecError(Exception):
+    pass
+
+
+class SSHExecBackend(object):
+    """Run scripts through `sudo bash -s`, streaming stdout and stderr into the log."""
+
+    name = 'ssh'
+
+    def __init__(self, ssh_client_factory):
+        self._ssh_client_factory = ssh_client_factory
+
+    def run(self, compute, script_lines):
+        started_at = monotonic()
+        first_output_at = None
+        output = []
+        streams = {'stdout': _LineBuffer(compute.name, 'stdout'), 'stderr': _LineBuffer(compute.name, 'stderr')}
+
+        with self._ssh_client_factory(compute) as ssh:
+            channel = ssh.get_transport().open_session()
+            try:
+                channel.exec_command('sudo bash -s')
+                channel.sendall('\n'.join(script_lines).encode() + b'\n')
+                channel.shutdown_write()
+
+                while True:
+                    received = False
+                    if channel.recv_ready():
+                        output.extend(streams['stdout'].feed(channel.recv(READ_SIZE)))
+                        received = True
+                    if channel.recv_stderr_ready():
+                        output.extend(streams['stderr'].feed(channel.recv_stderr(READ_SIZE)))
+                        received = True
+
+                    if received and first_output_at is None:
+                        first_output_at = monotonic()
+                    if not received:
+                        if channel.exit_status_ready() and not channel.recv_ready() and not channel.recv_stderr_ready():
+                            break
+                        select.select([channel], [], [], 0.1)
+
+                exit_status = channel.recv_exit_status()
+            finally:
+                channel.close()
+
+        for stream in streams.values():
+            output.extend(stream.flush())
+
+        return _result(self.name, exit_status, output, started_at, first_output_at)
+
+
+class RunCommandBackend(object):
+    """
+    Run scripts through the Run Command extension of the VM. The script runs
+    in a subshell followed by a line printing its exit status, which is then
+    read from the output; it is None when that line is missing.
+    """
+
+    name = 'run-command'
+
+    def __init__(self, execute_script, compute_client_factory):
+        self._execute_script = execute_script
+        self._compute_client_factory = compute_client_factory
+
+    def run(self, compute, script_lines):
+        started_at = monotonic()
+        message = self._execute_script(
+            compute.resource_group,
+            compute.name,
+            ['('] + list(script_lines) + [')', 'echo "{}$?"'.format(EXIT_STATUS_MARKER)],
+            self._compute_client_factory(),
+        )
+        first_output_at = monotonic() if message else None
+
+        exit_status = None
+        output = []
+        for line in (message or '').splitlines():
+            match = EXIT_STATUS_LINE.match(line.strip())
+            if match:
+                exit_status = int(match.group(1))
+                continue
+            LOG.debug('[%s] %s', compute.name, line)
+            output.append(line)
+
+        return _result(self.name, exit_status, output, started_at, first_output_at)
+
+
+def select_backend(compute, backends, probe_seconds=SSH_PROBE_SECONDS):
+    """
+    Pick the SSH backend when `compute` accepts SSH connections, and the
+    first other backend otherwise.
+    """
+    by_name = {backend.name: backend for backend in backends}
+    if SSHExecBackend.name in by_name:
+        try:
+            wait_for_ports([(compute.host, compute.port)], deadline_seconds=probe_seconds)
+        except NotReady:
+            LOG.debug('%s is not reachable over SSH', compute.name)
+        else:
+            return by_name[SSHExecBackend.name]
+
+    for backend in backends:
+        if backend.name != SSHExecBackend.name:
+            return backend
+    raise RemoteExecError('No backend available to reach {}'.format(compute.name))
+
+
+def run_script(compute, script_lines, backends, caller='remote_exec'):
+    """
+    Run `script_lines` on `compute` with the best available backend and record
+    its time to first output and total time.
+
+    :returns: an :class:`ExecResult`.
+    :raises RemoteExecError: when the script exits with a non-zero status, or
+                             its exit status is unknown.
+    """
+    backend = select_backend(compute, backends)
+    LOG.debug('Running script on %s through %s', compute.name, backend.name)
+    with metrics.span(caller, 'exec', backend=backend.name, host=compute.name):
+        result = backend.run(compute, script_lines)
+
+    timings = {'total_time': result.total_time}
+    if result.first_output_time is not None:
+        timings['first_output_time'] = result.first_output_time
+    metrics.record(caller, backend.name, **timings)
+
+    if result.exit_status is None:
+        raise RemoteExecError('Script on {} did not report its exit status'.format(compute.name))
+    if result.exit_status != 0:
+        raise RemoteExecError('Script on {} exited with status {}'.format(compute.name, result.exit_status))
+    return result
+
+
+class _LineBuffer(object):
+    def __init__(self, host, stream):
+        self.host = host
+        self.stream = stream
+        self._pending = b''
+
+    def feed(self, data):
+        lines = (self._pending + data).split(b'\n')
+        self._pending = lines.pop()
+        return [self._log(line) for line in lines]
+
+    def flush(self):
+        if not self._pending:
+            return []
+        line, self._pending = self._pending, b''
+        return [self._log(line)]
+
+    def _log(self, line):
+        text = line.decode(errors='replace').rstrip('\r')
+        LOG.debug('[%s %s] %s', self.host, self.stream, text)
+        return text
+
+
+def _result(backend, exit_status, output, started_at, first_output_at):
+    return ExecResult(
+        backend=backend,
+        exit_status=exit_status,
+        output='\n'.join(output),
+        first_output_time=None if first_output_at is None else first_output_at - started_at,
+        total_time=monotonic() - started_at,
+    )
@@ -1,21 +1,61 @@
 #!/bin/bash
-echo -n 'Waiting for disk'
-while [ ! -e /dev/sdc ] && [ ! -e /dev/sdc1 ]; do
-  echo -n '.'
-  sleep 1
-done
-echo ' done!'
-sudo mkdir /datadisk
-sudo mount /dev/sdc1 /datadisk
-if [ $? -eq 0 ]; then
-  sudo chown -v -R localadmin /datadisk/
-  exit 0
+# The caller prepends the following variables to this script:
+#   LUN      LUN the data disk is attached to
+#   MODE     "format" for a new disk, "mount" for a disk formatted earlier
+#   FS_UUID  UUID of the filesystem on the disk
+#   MOUNT    directory to mount the disk on
+#   OWNER    user owning the root of the filesystem
+# ROOT, empty on Azure, prefixes the paths of the guest when it is emulated
+# by the offline backend.
+DISK=${ROOT}/dev/disk/azure/scsi1/lun${LUN:-0}
+MOUNT=${ROOT}${MOUNT:-/datadisk}
+OWNER=${OWNER:-localadmin}
+TIMEOUT=120
+
+# Wait on udev block events rather than sleeping between checks. The device
+# is re-checked after every event, and at least every second to cover events
+# raised before the monitor was listening.
+wait_for_device() {
+  local deadline=$((SECONDS + TIMEOUT))
+  coproc MONITOR { exec udevadm monitor --udev --subsystem-match=block; }
+  while [ ! -e "$1" ] && [ $SECONDS -lt $deadline ]; do
+    read -r -t 1 -u "${MONITOR[0]}" _
+  done
+  kill "$MONITOR_PID" 2>/dev/null
+  [ -e "$1" ]
+}
+
+echo "Waiting for $DISK"
+if ! wait_for_device "$DISK"; then
+  echo "$DISK did not appear within ${TIMEOUT}s" >&2
+  exit 1
 fi
-echo 'size=50M,type=83' | sudo sfdisk /dev/sdc
-sudo mkfs -t ext4 /dev/sdc1
-sudo mount /dev/sdc1 /datadisk
-sudo chown -v -R localadmin /datadisk/
-touch /datadisk/demo
-fallocate -l 2k /datadisk/demo
-sudo chown -v -R localadmin /datadisk/demo
-exit 0
\ No newline at end of file
+echo "$DISK is $(readlink -f "$DISK")"
+
+set -e
+sudo mkdir -p "$MOUNT"
+
+case "$MODE" in
+  mount)
+    # Already formatted: mount only, and never reformat if that fails.
+    udevadm settle --timeout=10
+    sudo mount "UUID=$FS_UUID" "$MOUNT"
+    ;;
+  format)
+    # The whole disk holds the filesystem; inode tables and the journal are
+    # initialized lazily by the kernel after mounting.
+    sudo mkfs.ext4 -q -F -U "$FS_UUID" -E lazy_itable_init=1,lazy_journal_init=1 "$DISK"
+    sudo mount "$DISK" "$MOUNT"
+    sudo fallocate -l 2k "$MOUNT/demo"
+    sudo chown "$OWNER" "$MOUNT/demo"
+    ;;
+  *)
+    echo "Unknown mode '$MODE'" >&2
+    exit 1
+    ;;
+esac
+
+# Only the root of the volume, so re-attaching costs the same however much
+# data it holds.
+sudo chown "$OWNER" "$MOUNT"
+echo "Mounted $FS_UUID on $MOUNT"
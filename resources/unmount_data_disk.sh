@@ -0,0 +1,28 @@
+#!/bin/bash
+# The caller prepends the following variables to this script:
+#   MOUNT    directory the data disk is mounted on
+# ROOT, empty on Azure, prefixes the paths of the guest when it is emulated
+# by the offline backend.
+MOUNT=${ROOT}${MOUNT:-/datadisk}
+
+set -e
+if mountpoint -q "$MOUNT"; then
+  # Write back the dirty pages of this filesystem only, then unmount, which
+  # leaves it clean on disk.
+  sync -f "$MOUNT"
+  # Processes still holding files of the disk open, such as an sftp-server
+  # of a session that did not close its files, would keep it busy. Stop
+  # them; fuser fails when there are none.
+  fuser -km "$MOUNT" || true
+  if ! umount "$MOUNT"; then
+    # Detaching a disk whose filesystem is still in use corrupts it.
+    echo "$MOUNT is still in use, not detaching it" >&2
+    exit 1
+  fi
+fi
+
+if mountpoint -q "$MOUNT"; then
+  echo "$MOUNT is still mounted" >&2
+  exit 1
+fi
+echo "Unmounted $MOUNT"
@@ -0,0 +1,154 @@
+# encoding: utf-8
+
+"""
+Bulk SFTP transfers to and from compute instances.
+
+By default paramiko waits for the acknowledgement of every 32KB write and
+reads one request at a time, so throughput is bounded by the round-trip time
+rather than the link. Here uploads are pipelined: write requests are sent
+back to back and their acknowledgements collected as they arrive, errors
+surfacing on close at the latest. Downloads are prefetched `prefetch_bytes`
+at a time, which bounds the memory held by replies received ahead of the
+reader. The SFTP channel is opened with a window large enough to keep the
+link busy and packets holding a whole read reply.
+
+Sources and destinations are local files, which are memory-mapped, or
+bytes-like objects such as `bytes`, `bytearray`, `memoryview` or `mmap`.
+Uploads send slices of a memoryview over the source, so its contents are
+only copied into the outgoing packets.
+"""
+
+import mmap
+import os
+from collections import namedtuple
+from contextlib import contextmanager
+from logging import getLogger
+from time import monotonic
+
+from tests.metrics import metrics
+
+LOG = getLogger('vendor.sftp_transfer')
+
+METRICS_NAME = 'sftp_transfer'
+
+DEFAULT_WINDOW_SIZE = 32 * 1024 * 1024
+# OpenSSH accepts SFTP messages of up to 256KB, but answers reads with at
+# most 64KB of data.
+DEFAULT_WRITE_REQUEST_SIZE = 128 * 1024
+DEFAULT_READ_REQUEST_SIZE = 64 * 1024
+DEFAULT_PREFETCH_BYTES = 64 * 1024 * 1024
+# Room for the SFTP and SSH headers around a whole read reply.
+PACKET_OVERHEAD = 1024
+
+Transfer = namedtuple('Transfer', ['path', 'size', 'seconds', 'mb_per_s'])
+
+
+def open_sftp(ssh_client, window_size=DEFAULT_WINDOW_SIZE, read_request_size=DEFAULT_READ_REQUEST_SIZE):
+    """Open an SFTP session on the transport of `ssh_client` with a tuned channel."""
+    import paramiko
+
+    return paramiko.SFTPClient.from_transport(
+        ssh_client.get_transport(),
+        window_size=window_size,
+        max_packet_size=read_request_size + PACKET_OVERHEAD,
+    )
+
+
+def upload(sftp, source, path, request_size=DEFAULT_WRITE_REQUEST_SIZE):
+    """
+    Write `source` to the remote file `path`, replacing it.
+
+    :param sftp: `paramiko.SFTPClient`, ideally from :func:`open_sftp`.
+    :param source: name of a local file, or a bytes-like object.
+    :returns: a :class:`Transfer`.
+    """
+    with _local_view(source) as view:
+        started_at = monotonic()
+        with metrics.span('sftp_upload', 'ssh', path=path, size=len(view)):
+            # Unbuffered, so the memoryview is handed to paramiko as is.
+            with sftp.open(path, 'wb', bufsize=0) as f:
+                f.MAX_REQUEST_SIZE = request_size
+                f.set_pipelined(True)
+                f.write(view)
+        return _record('upload', 'Uploaded', path, len(view), started_at)
+
+
+def download(sftp, path, destination, request_size=DEFAULT_READ_REQUEST_SIZE, prefetch_bytes=DEFAULT_PREFETCH_BYTES):
+    """
+    Read the remote file `path` into `destination`.
+
+    :param sftp: `paramiko.SFTPClient`, ideally from :func:`open_sftp`.
+    :param destination: name of a local file, created or replaced, or a
+                        writable buffer at least as large as the remote file.
+    :returns: a :class:`Transfer`.
+    """
+    started_at = monotonic()
+    with metrics.span('sftp_download', 'ssh', path=path):
+        with sftp.open(path, 'rb', bufsize=0) as f:
+            f.MAX_REQUEST_SIZE = request_size
+            size = f.stat().st_size
+            if isinstance(destination, (str, os.PathLike)):
+                with _mapped_file(destination, size) as buffer:
+                    _read_into(f, buffer, size, request_size, prefetch_bytes)
+            else:
+                _read_into(f, destination, size, request_size, prefetch_bytes)
+    return _record('download', 'Downloaded', path, size, started_at)
+
+
+def _read_into(f, buffer, size, request_size, prefetch_bytes):
+    # Views are released on the way out, so a mapped buffer can be closed.
+    with memoryview(buffer) as base, base.cast('B') as view:
+        if len(view) < size:
+            raise ValueError('{} bytes do not fit in a buffer of {} bytes'.format(size, len(view)))
+
+        # The pipeline drains at the end of every window: one round trip per
+        # `prefetch_bytes`, against one per request without prefetching.
+        for window in range(0, size, prefetch_bytes):
+            window_end = min(window + prefetch_bytes, size)
+            chunks = [(start, min(request_size, window_end - start)) for start in range(window, window_end, request_size)]
+            for (start, length), data in zip(chunks, f.readv(chunks)):
+                if len(data) != length:
+                    raise EOFError('Short read at offset {}: {} bytes instead of {}'.format(start, len(data), length))
+                view[start:start + length] = data
+
+
+@contextmanager
+def _local_view(source):
+    """Yield a byte memoryview of a bytes-like object or of a mapped local file."""
+    if not isinstance(source, (str, os.PathLike)):
+        with memoryview(source) as base, base.cast('B') as view:
+            yield view
+        return
+
+    with open(source, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            yield memoryview(b'')
+            return
+        # A mapping cannot be closed while views on it are alive.
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+            yield view
+
+
+@contextmanager
+def _mapped_file(filename, size):
+    """Yield a writable mapping of the local file `filename`, created with `size` bytes."""
+    with open(filename, 'w+b') as f:
+        if not size:
+            yield bytearray()
+            return
+        f.truncate(size)
+        with mmap.mmap(f.fileno(), size) as mapped:
+            yield mapped
+
+
+def _record(name, action, path, size, started_at):
+    elapsed = monotonic() - started_at
+    transfer = Transfer(
+        path=path,
+        size=size,
+        seconds=elapsed,
+        mb_per_s=size / elapsed / 1e6 if elapsed else 0.0,
+    )
+    LOG.debug('%s %s: %d bytes, %.2fs (%.1f MB/s)', action, path, size, elapsed, transfer.mb_per_s)
+    metrics.record(METRICS_NAME, name, transfer_time=elapsed, mb_per_s=transfer.mb_per_s)
+    return transfer
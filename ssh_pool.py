@@ -0,0 +1,109 @@
+# encoding: utf-8
+
+"""
+Pool of authenticated SSH transports, one per compute instance.
+
+Clients handed out by the pool share their host's transport: every command
+and SFTP session is a new channel on it, so the key exchange and
+authentication only happen once per host.
+"""
+
+import threading
+from collections import defaultdict
+from logging import getLogger
+
+import paramiko
+
+LOG = getLogger('vendor.ssh_pool')
+
+
+class PooledSSHClient(paramiko.SSHClient):
+    """
+    `paramiko.SSHClient` running on a pooled transport. Closing it releases
+    the client but leaves the transport open for the next user.
+    """
+
+    def __init__(self, transport):
+        super(PooledSSHClient, self).__init__()
+        self._transport = transport
+
+    def close(self):
+        if self._agent is not None:
+            self._agent.close()
+            self._agent = None
+        self._transport = None
+
+
+class TransportPool(object):
+    """
+    :param connect: callable taking a compute handle and returning a connected
+                    `paramiko.SSHClient`, used whenever a new handshake is needed.
+    :param keepalive_seconds: interval of the keepalive packets sent on every
+                              pooled transport.
+    """
+
+    def __init__(self, connect, keepalive_seconds=15):
+        self._connect = connect
+        self.keepalive_seconds = keepalive_seconds
+        self._lock = threading.Lock()
+        self._host_locks = defaultdict(threading.Lock)
+        self._connections = {}
+        self.handshakes = 0
+        self.reuses = 0
+
+    def client(self, handle):
+        """Return an SSH client for `handle` on its pooled transport."""
+        return PooledSSHClient(self.transport(handle))
+
+    def transport(self, handle):
+        with self._lock:
+            host_lock = self._host_locks[handle]
+
+        with host_lock:
+            connection = self._connections.get(handle)
+            if connection is not None and connection.get_transport().is_active():
+                with self._lock:
+                    self.reuses += 1
+                return connection.get_transport()
+
+            if connection is not None:
+                LOG.debug('Pooled transport to %s is no longer active, reconnecting', handle.host)
+                connection.close()
+
+            connection = self._connect(handle)
+            transport = connection.get_transport()
+            transport.set_keepalive(self.keepalive_seconds)
+            self._connections[handle] = connection
+            with self._lock:
+                self.handshakes += 1
+            return transport
+
+    def discard(self, handle):
+        """Close the pooled transport of `handle`, if any."""
+        with self._lock:
+            host_lock = self._host_locks.pop(handle, None)
+        if host_lock is None:
+            return
+
+        with host_lock:
+            connection = self._connections.pop(handle, None)
+            if connection is not None:
+                connection.close()
+
+    def close_all(self):
+        with self._lock:
+            handles = list(self._host_locks)
+        for handle in handles:
+            self.discard(handle)
+
+        LOG.info(
+            'SSH pool: %d handshakes, %d reuses (reuse ratio %.0f%%)',
+            self.handshakes,
+            self.reuses,
+            100.0 * self.reuse_ratio,
+        )
+
+    @property
+    def reuse_ratio(self):
+        total = self.handshakes + self.reuses
+        return self.reuses / total if total else 0.0
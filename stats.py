@@ -0,0 +1,28 @@
+# encoding: utf-8
+
+"""
+Summary statistics shared by the test harness and the benchmarks, kept free
+of dependencies so standalone scripts can import them.
+"""
+
+import math
+
+
+def percentile(values, fraction):
+    """
+    Nearest-rank percentile of `values`, which must be sorted: the smallest
+    value with at least `fraction` of the values at or below it.
+
+    >>> percentile([1, 2], 0.5)
+    1
+    >>> percentile([1, 2, 3, 4, 5, 6], 0.5)
+    3
+    >>> percentile(list(range(1, 21)), 0.95)
+    19
+    >>> percentile(list(range(1, 101)), 0.99)
+    99
+    >>> percentile([7], 0.0), percentile([7], 1.0)
+    (7, 7)
+    """
+    rank = max(math.ceil(fraction * len(values)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
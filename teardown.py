@@ -0,0 +1,92 @@
+# encoding: utf-8
+
+"""
+Track resource group deletions started during a run.
+
+Deletions are polled together on a background thread while later cases keep
+running, and the run can wait on all of them with a single deadline before it
+exits.
+"""
+
+import threading
+from collections import namedtuple
+from logging import getLogger
+from time import monotonic, sleep
+
+LOG = getLogger('vendor.teardown')
+
+POLLING_INTERVAL_SECONDS = 5
+
+Deletion = namedtuple('Deletion', ['name', 'latency', 'error'])
+
+
+class DeletionTracker(object):
+    def __init__(self, polling_interval_seconds=POLLING_INTERVAL_SECONDS):
+        self.polling_interval_seconds = polling_interval_seconds
+        self._condition = threading.Condition()
+        self._pending = {}
+        self._completed = []
+        self._polling = False
+
+    def track(self, name, poller):
+        """Follow the deletion of resource group `name` through its poller."""
+        with self._condition:
+            self._pending[name] = (poller, monotonic())
+            if not self._polling:
+                self._polling = True
+                threading.Thread(target=self._poll_loop, name='teardown', daemon=True).start()
+
+    def wait(self, deadline_seconds):
+        """
+        Wait until every tracked deletion has completed or `deadline_seconds`
+        have passed.
+
+        :returns: the names of the resource groups still being deleted.
+        """
+        deadline = monotonic() + deadline_seconds
+        with self._condition:
+            while self._pending:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            return sorted(self._pending)
+
+    def summary(self):
+        """Completed deletions, slowest first, followed by pending ones."""
+        now = monotonic()
+        with self._condition:
+            completed = sorted(self._completed, key=lambda deletion: -deletion.latency)
+            pending = [
+                Deletion(name=name, latency=now - started_at, error=None)
+                for name, (_, started_at) in sorted(self._pending.items())
+            ]
+        return completed, pending
+
+    def _poll_loop(self):
+        while True:
+            with self._condition:
+                if not self._pending:
+                    self._polling = False
+                    return
+                tracked = list(self._pending.items())
+
+            for name, (poller, started_at) in tracked:
+                if not poller.done():
+                    continue
+
+                error = None
+                try:
+                    poller.result()
+                except Exception as ex:
+                    error = ex
+                    LOG.warning('Error deleting resource group %s: %s', name, ex)
+
+                latency = monotonic() - started_at
+                LOG.debug('Resource group %s deleted in %.2fs', name, latency)
+                with self._condition:
+                    del self._pending[name]
+                    self._completed.append(Deletion(name=name, latency=latency, error=error))
+                    self._condition.notify_all()
+
+            sleep(self.polling_interval_seconds)
@@ -4,6 +4,7 @@ from .common import test
 
 from . import (
     test_compute,
+    test_compute_pool,
     test_block_storage,
     test_object_storage,
     test_relational,
@@ -1,16 +1,22 @@
 # encoding: utf-8
 
 import contextlib
+import io
+import sys
+import threading
 from colorama import Fore, Style
 import time
 
+from .metrics import metrics
+
 
 def output_wrapper(fn):
     def shim(*args, **kwargs):
         name = fn.__name__
         try:
             print("{} starting".format(name) + Style.RESET_ALL)
-            fn(*args, **kwargs)
+            with metrics.span(name, "test"):
+                fn(*args, **kwargs)
             print(Fore.GREEN + "{} completed".format(name) + Fore.RESET)
         except NotImplementedError as e:
             print(Fore.YELLOW + "{} not implemented: {}".format(name, e) + Style.RESET_ALL)
@@ -18,6 +24,7 @@ def output_wrapper(fn):
             print(Fore.RED + "{} failed ({}): {}".format(name, type(e).__name__, e) + Style.RESET_ALL)
 
     shim.__name__ = fn.__name__
+    shim.__wrapped__ = fn
     return shim
 
 
@@ -32,6 +39,56 @@ class Test(object):
 test = Test()
 
 
+class ThreadLocalStdout(object):
+    """
+    Stand-in for `sys.stdout` that sends writes made by a thread into that
+    thread's buffer when one is active, and to the real stream otherwise.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self._local = threading.local()
+
+    @property
+    def buffer(self):
+        return getattr(self._local, "buffer", None)
+
+    @buffer.setter
+    def buffer(self, value):
+        self._local.buffer = value
+
+    def write(self, data):
+        return (self.buffer or self.stream).write(data)
+
+    def flush(self):
+        (self.buffer or self.stream).flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+_stdout_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def buffered_output():
+    """
+    Capture everything the current thread prints while the block runs, so
+    concurrently running cases don't interleave their output. Yields the
+    `io.StringIO` holding the captured text.
+    """
+    with _stdout_lock:
+        if not isinstance(sys.stdout, ThreadLocalStdout):
+            sys.stdout = ThreadLocalStdout(sys.stdout)
+        stdout = sys.stdout
+
+    previous = stdout.buffer
+    stdout.buffer = io.StringIO()
+    try:
+        yield stdout.buffer
+    finally:
+        stdout.buffer = previous
+
+
 def file_exists(client, path):
     return must_run(client, "[ -e {} ]".format(path)) == 0
 
@@ -1,47 +1,262 @@
 import time
 import contextlib
 import collections
+import csv
+import itertools
+import json
+import sys
+import threading
 from colorama import Fore, Style
 
+from stats import percentile
+
+
+# One timed step of a run. `parent_id` is the span that was open on the same
+# thread when this one started; asynchronous spans overlap their siblings,
+# such as pollers watched together from one loop.
+Span = collections.namedtuple(
+    "Span", ["id", "parent_id", "name", "category", "thread_id", "thread_name", "started_at", "ended_at", "asynchronous", "args"])
+
 
 class Metrics(object):
     def __init__(self):
         self.measurements = collections.defaultdict(list)
+        self.counters = collections.defaultdict(collections.Counter)
+        self.spans = []
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._local = threading.local()
 
     def measure(self, caller, name, started_at, yielded_at, external_completed_at, cleanup_completed_at):
-        startup_time = yielded_at - started_at
-        external_time = external_completed_at - yielded_at
-        cleanup_time = cleanup_completed_at - external_completed_at
-        self.measurements[caller].append({
-            "name": name,
-            "startup_time": startup_time,
-            "external_time": external_time,
-            "cleanup_time": cleanup_time,
-        })
+        self.record(
+            caller,
+            name,
+            startup_time=yielded_at - started_at,
+            external_time=external_completed_at - yielded_at,
+            cleanup_time=cleanup_completed_at - external_completed_at,
+        )
+
+    def record(self, caller, name, **timings):
+        """
+        Record the duration in seconds of one or more phases of `name`,
+        e.g. `record("attach", "ssh", first_output_time=0.2, total_time=3.1)`.
+        Phase names ending in `_time` are printed as seconds without that
+        suffix, other values (such as rates) are printed as they are.
+        """
+        with self._lock:
+            self.measurements[caller].append(dict(name=name, **timings))
+
+    def count(self, caller, name, increment=1):
+        """Add `increment` to the counter `name`, e.g. cache hits."""
+        with self._lock:
+            self.counters[caller][name] += increment
+
+    @contextlib.contextmanager
+    def span(self, name, category="step", **args):
+        """
+        Time the enclosed block as a span, nested under the span currently
+        open on this thread, e.g. `with metrics.span("attach_disk", "arm"):`.
+        """
+        stack = self._stack()
+        span_id = next(self._ids)
+        parent_id = stack[-1] if stack else None
+        started_at = time.monotonic()
+        stack.append(span_id)
+        try:
+            yield span_id
+        finally:
+            stack.pop()
+            self._add(span_id, parent_id, name, category, started_at, time.monotonic(), False, args)
+
+    def record_span(self, name, category, started_at, ended_at, asynchronous=False, **args):
+        """
+        Record a span measured by the caller with `time.monotonic()`, under
+        the span currently open on this thread.
+        """
+        stack = self._stack()
+        self._add(next(self._ids), stack[-1] if stack else None, name, category, started_at, ended_at, asynchronous, args)
+
+    def write_chrome_trace(self, path):
+        """Write the spans as Chrome trace events, viewable in chrome://tracing or Perfetto."""
+        with self._lock:
+            spans = list(self.spans)
+        origin = min((span.started_at for span in spans), default=0.0)
+
+        events = []
+        for thread_id, thread_name in sorted({(span.thread_id, span.thread_name) for span in spans}):
+            events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": thread_id, "args": {"name": thread_name}})
+        for span in spans:
+            event = {
+                "name": span.name,
+                "cat": span.category,
+                "pid": 1,
+                "tid": span.thread_id,
+                "ts": (span.started_at - origin) * 1e6,
+                "args": dict(span.args, span_id=span.id, parent_id=span.parent_id),
+            }
+            if span.asynchronous:
+                events.append(dict(event, ph="b", id=span.id))
+                events.append(dict(event, ph="e", id=span.id, ts=(span.ended_at - origin) * 1e6))
+            else:
+                events.append(dict(event, ph="X", dur=(span.ended_at - span.started_at) * 1e6))
+
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    def write_csv(self, path):
+        """Write one row per span, with start times relative to the first span."""
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span.started_at)
+        origin = spans[0].started_at if spans else 0.0
+
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["id", "parent_id", "name", "category", "thread", "start_s", "duration_s", "args"])
+            for span in spans:
+                writer.writerow([
+                    span.id,
+                    span.parent_id or "",
+                    span.name,
+                    span.category,
+                    span.thread_name,
+                    "{:.6f}".format(span.started_at - origin),
+                    "{:.6f}".format(span.ended_at - span.started_at),
+                    json.dumps(span.args, default=str) if span.args else "",
+                ])
+
+    def summary(self):
+        """
+        Aggregate every recorded phase as
+        `{caller: {name: {phase: {"min", "p50", "p95", "max", "samples"}}}}`.
+        """
+        with self._lock:
+            snapshot = [(caller, list(measurements)) for (caller, measurements) in self.measurements.items()]
+
+        samples = collections.defaultdict(list)
+        for (caller, measurements) in snapshot:
+            for measurement in measurements:
+                for phase, value in measurement.items():
+                    if phase != "name":
+                        samples[(caller, measurement["name"], phase)].append(value)
+
+        summary = {}
+        for (caller, name, phase), values in sorted(samples.items()):
+            values.sort()
+            summary.setdefault(caller, {}).setdefault(name, {})[phase] = {
+                "min": values[0],
+                "p50": percentile(values, 0.50),
+                "p95": percentile(values, 0.95),
+                "max": values[-1],
+                "samples": len(values),
+            }
+        return summary
+
+    def output_summary(self):
+        for (caller, names) in self.summary().items():
+            print("")
+            print(Fore.WHITE + Style.BRIGHT + caller + Style.RESET_ALL)
+            rows = [(name, phase, stats) for (name, phases) in names.items() for (phase, stats) in phases.items()]
+            prefix = iter((["├"] * (len(rows)-1)) + ["└"])
+
+            for (name, phase, stats) in rows:
+                unit = "s" if phase.endswith("_time") else ""
+                print(" {prefix} {name} {phase} min {min:0.2f}{unit} p50 {p50:0.2f}{unit} p95 {p95:0.2f}{unit} "
+                      "max {max:0.2f}{unit} (n={samples})".format(
+                          prefix=next(prefix), name=name, phase=_phase_label(phase), unit=unit, **stats))
 
     def output(self):
-        for (caller, measurements) in self.measurements.items():
+        with self._lock:
+            snapshot = [(caller, list(measurements)) for (caller, measurements) in self.measurements.items()]
+            counters = [(caller, sorted(counter.items())) for (caller, counter) in self.counters.items()]
+
+        for (caller, measurements) in snapshot:
             print("")
             print(Fore.WHITE + Style.BRIGHT + caller + Style.RESET_ALL)
             prefix = iter((["├"] * (len(measurements)-1)) + ["└"])
 
             for measurement in measurements:
-                print(" {prefix} {name} startup {startup_time:0.2f}s external {external_time:0.2f}s cleanup {cleanup_time:0.2f}s".format(prefix=next(prefix), **measurement))
+                phases = " ".join(
+                    "{} {:0.2f}s".format(phase[:-len("_time")], value) if phase.endswith("_time")
+                    else "{} {}".format(phase, value) if isinstance(value, int)
+                    else "{} {:0.2f}".format(phase, value)
+                    for phase, value in measurement.items() if phase != "name")
+                print(" {prefix} {name} {phases}".format(prefix=next(prefix), name=measurement["name"], phases=phases))
+
+        for (caller, counts) in counters:
+            print("")
+            print(Fore.WHITE + Style.BRIGHT + caller + Style.RESET_ALL)
+            prefix = iter((["├"] * (len(counts)-1)) + ["└"])
+
+            for (name, value) in counts:
+                print(" {prefix} {name} {value}".format(prefix=next(prefix), name=name, value=value))
 
     def __call__(self, fn):
         @contextlib.contextmanager
         def inner(*args, **kwargs):
-            import inspect
-            caller = inspect.stack()[2].function
+            # Frame 0 is this generator and frame 1 contextlib's __enter__.
+            caller = sys._getframe(2).f_code.co_name
 
-            started_at = time.time()
-            with fn(*args, **kwargs) as d:
+            with self.span(fn.__name__, "helper", caller=caller):
+                started_at = time.time()
+                with self.span("startup", "helper"):
+                    context = fn(*args, **kwargs)
+                    d = context.__enter__()
                 yielded_at = time.time()
-                yield d
-                external_completed_at = time.time()
-            cleanup_completed_at = time.time()
+                try:
+                    yield d
+                except BaseException:
+                    external_completed_at = time.time()
+                    with self.span("cleanup", "helper"):
+                        if not context.__exit__(*sys.exc_info()):
+                            raise
+                else:
+                    external_completed_at = time.time()
+                    with self.span("cleanup", "helper"):
+                        context.__exit__(None, None, None)
+                cleanup_completed_at = time.time()
             self.measure(caller, fn.__name__, started_at, yielded_at, external_completed_at, cleanup_completed_at)
         inner.has_metrics = True
         return inner
 
+    def _stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _add(self, span_id, parent_id, name, category, started_at, ended_at, asynchronous, args):
+        thread = threading.current_thread()
+        span = Span(span_id, parent_id, name, category, thread.ident, thread.name, started_at, ended_at, asynchronous, args)
+        with self._lock:
+            self.spans.append(span)
+
+
+def find_regressions(summary, baseline, threshold, min_delta_seconds=0.0):
+    """
+    Compare the medians of `summary` with those of `baseline`, both from
+    `Metrics.summary()`. Only duration phases are compared, as other values
+    (such as throughput) do not get worse by growing.
+
+    :returns: `(caller, name, phase, baseline_p50, p50)` for every phase whose
+              median grew by more than `threshold` (0.2 for 20%) and by more
+              than `min_delta_seconds`.
+    """
+    regressions = []
+    for caller, names in sorted(summary.items()):
+        for name, phases in sorted(names.items()):
+            for phase, stats in sorted(phases.items()):
+                if not phase.endswith("_time"):
+                    continue
+                reference = baseline.get(caller, {}).get(name, {}).get(phase)
+                if reference is None:
+                    continue
+                delta = stats["p50"] - reference["p50"]
+                if delta > reference["p50"] * threshold and delta > min_delta_seconds:
+                    regressions.append((caller, name, phase, reference["p50"], stats["p50"]))
+    return regressions
+
+
+def _phase_label(phase):
+    return phase[:-len("_time")] if phase.endswith("_time") else phase
+
 metrics = Metrics()
@@ -1,45 +1,43 @@
 # encoding: utf-8
 
-import contextlib
-
 from .common import test
 
 from vendor import (
-    create_compute_instance,
+    create_compute_instances,
     create_block_storage_instance,
-    create_compute_ssh_client,
 
     attach_block_storage_to_compute,
     remove_block_storage_from_compute,
+
+    compute_upload,
+    compute_download,
 )
 
+# Large enough for the transfers to take many SFTP requests.
+PAYLOAD_SIZE = 8 * 1024 * 1024
+
 
 @test
 def test_block_storage(resource_group_name):
     with create_block_storage_instance(resource_group_name) as block, \
-            create_compute_instance(resource_group_name) as compute1, \
-            create_compute_instance(resource_group_name) as compute2:
+            create_compute_instances(resource_group_name, 2) as (compute1, compute2):
 
         phrase = b"Nobody inspects the spammish repetition"
+        payload = bytearray(PAYLOAD_SIZE)
+        payload[1337:1337 + len(phrase)] = phrase
 
-        ssh = create_compute_ssh_client(compute1)
         path = attach_block_storage_to_compute(compute1, block)
-        sftp = ssh.open_sftp()
-
-        fo = sftp.file(path, 'wb')
-        fo.seek(1337)
-        fo.write(phrase)
-        fo.flush()
-        fo.close()
+        compute_upload(compute1, payload, path)
         remove_block_storage_from_compute(compute1, block)
 
-        ssh = create_compute_ssh_client(compute2)
         path = attach_block_storage_to_compute(compute2, block)
-        sftp = ssh.open_sftp()
-        fo = sftp.file(path, 'rb')
-        fo.seek(1337)
-        read_back = fo.read(len(phrase))
+        read_back = bytearray(PAYLOAD_SIZE)
+        transfer = compute_download(compute2, path, read_back)
         remove_block_storage_from_compute(compute2, block)
 
-        assert read_back == phrase, \
+        assert transfer.size == PAYLOAD_SIZE, \
+            "Data node 1 wrote to block storage has the wrong size on node 2."
+        assert read_back[1337:1337 + len(phrase)] == phrase, \
             "Data node 1 wrote to block storage didn't read on node 2."
+        assert read_back == payload, \
+            "Data node 1 wrote to block storage was corrupted on node 2."
@@ -3,7 +3,7 @@
 import contextlib
 
 from .common import file_exists, must_run, test
-from vendor import create_compute_ssh_client, create_compute_instance
+from vendor import create_compute_ssh_client, create_compute_instance, create_compute_instances
 
 
 @contextlib.contextmanager
@@ -15,9 +15,15 @@ def new_compute_instance(resource_group_name):
         yield create_compute_ssh_client(node)
 
 
+@contextlib.contextmanager
+def new_compute_instances(resource_group_name, count):
+    with create_compute_instances(resource_group_name, count) as nodes:
+        yield [create_compute_ssh_client(node) for node in nodes]
+
+
 @test
 def test_multiple_compute(resource_group_name):
-    with new_compute_instance(resource_group_name) as compute1, new_compute_instance(resource_group_name) as compute2:
+    with new_compute_instances(resource_group_name, 2) as (compute1, compute2):
         compute1.open_sftp().file("seen", 'wb').close()
         try:
             compute2.open_sftp().file("seen", 'rb').close()
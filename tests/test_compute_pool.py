@@ -0,0 +1,103 @@
+# encoding: utf-8
+
+import contextlib
+
+from .common import test
+
+from compute_pool import ComputePool, InvalidTransition, VmState
+from hackaton_compute import deploy_vms
+from offline_backend import Latency, OfflineCloud
+from vendor import ADMIN_USERNAME, RESOURCE_GROUP_LOCATION, ComputeHandle
+
+# The pool is driven by the management clients of the offline backend, so
+# these cases do not create VMs whichever backend the suite runs against.
+PUBLIC_KEY = "ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAABAQ== pool@test"
+
+
+@contextlib.contextmanager
+def offline_pool(resource_group_name, size, provisioned=None):
+    """
+    Yield a `ComputePool` of `size` VMs of an offline cloud, only
+    `provisioned` of which are actually created, the list of the names of
+    the VMs it reset and a set of the names of the VMs failing their reset.
+    """
+    cloud = OfflineCloud(latency=Latency(lro_seconds=0.05, call_seconds=0))
+    compute_client = cloud.client("compute")
+    resets = []
+    broken = set()
+
+    def provision(count):
+        names = ["vm{}".format(index) for index in range(count if provisioned is None else provisioned)]
+        deployed = deploy_vms(resource_group_name, RESOURCE_GROUP_LOCATION, names, ADMIN_USERNAME, PUBLIC_KEY,
+                              cloud.client("network"), compute_client)
+        return [
+            ComputeHandle(resource_group=resource_group_name, name=name, host=deployed[name][1],
+                          port=cloud.ssh_port(name), username=ADMIN_USERNAME)
+            for name in names
+        ]
+
+    def reset(handle):
+        compute_client.virtual_machines.get(handle.resource_group, handle.name)
+        resets.append(handle.name)
+        if handle.name in broken:
+            raise RuntimeError("{} is broken".format(handle.name))
+
+    cloud.client("resource").resource_groups.create_or_update(resource_group_name, {"location": RESOURCE_GROUP_LOCATION})
+    pool = ComputePool(size=size, provision=provision, reset=reset)
+    try:
+        yield pool, resets, broken
+    finally:
+        pool.drain()
+        cloud.close()
+
+
+@test
+def test_compute_pool_lease_release(resource_group_name):
+    with offline_pool(resource_group_name, 2) as (pool, resets, _):
+        pool.fill().result()
+        assert set(pool.states().values()) == {VmState.READY}, \
+            "pooled VMs should be ready once provisioned"
+
+        first = pool.lease(timeout=5)
+        second = pool.lease(timeout=5)
+        assert first is not None and second is not None and first != second, \
+            "two leases should get two different VMs"
+        assert pool.lease(timeout=0) is None, \
+            "a lease should fail when every VM is leased"
+
+        pool.release(first)
+        assert pool.lease(timeout=5) == first, \
+            "a released VM should be leased again once reset"
+        assert resets == [first.name], \
+            "only the released VM should have been reset"
+
+        pool.release(first)
+        try:
+            pool.release(first)
+        except InvalidTransition:
+            pass
+        else:
+            assert False, "releasing a VM twice should be refused"
+
+    assert set(pool.states().values()) == {VmState.DRAINED}, \
+        "every VM should be drained with the pool"
+    assert pool.lease(timeout=0) is None, \
+        "a drained pool should not lease VMs"
+
+
+@test
+def test_compute_pool_failures(resource_group_name):
+    with offline_pool(resource_group_name, 2, provisioned=1) as (pool, resets, broken):
+        pool.fill().result()
+        assert sorted(state.value for state in pool.states().values()) == ["failed", "ready"], \
+            "a VM that was not provisioned should be failed"
+
+        handle = pool.lease(timeout=5)
+        broken.add(handle.name)
+        pool.release(handle)
+        assert pool.lease(timeout=5) is None, \
+            "a VM failing its reset should be retired"
+        assert resets == [handle.name], \
+            "the released VM should have been reset"
+        assert set(pool.states().values()) == {VmState.FAILED}, \
+            "every VM should be failed"
@@ -0,0 +1,88 @@
+# encoding: utf-8
+
+"""
+ARM credentials refreshed in the background.
+
+msrest, and the requests stack under it, are slow to import, so
+`client_factory` only imports this module when it creates the first client.
+"""
+
+import threading
+from datetime import datetime, timedelta
+from logging import getLogger
+
+from msrest.authentication import Authentication
+
+LOG = getLogger('vendor.token_credentials')
+
+# ADAL only hands out a new token once the cached one is this close to expiry.
+TOKEN_REFRESH_MARGIN = timedelta(minutes=4)
+TOKEN_REFRESH_RETRY_SECONDS = 30
+
+
+class RefreshingTokenCredentials(Authentication):
+    """
+    Credentials serving a cached ARM token, which a background thread swaps
+    for a new one before it expires, so requests never wait on a refresh.
+    """
+
+    def __init__(self, profile, refresh_margin=TOKEN_REFRESH_MARGIN):
+        self._profile = profile
+        self._refresh_margin = refresh_margin
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self.scheme = None
+        self.token = None
+        self.expires_on = None
+        self.subscription_id = None
+        self.refreshes = 0
+
+        self.refresh()
+
+    def signed_session(self, session=None):
+        session = super(RefreshingTokenCredentials, self).signed_session(session)
+        with self._lock:
+            session.headers['Authorization'] = '{} {}'.format(self.scheme, self.token)
+        return session
+
+    def refresh(self):
+        (scheme, token, entry), subscription_id, _ = self._profile.get_raw_token()
+        # str() of a datetime, which leaves out the microseconds when they are 0.
+        expires_on = datetime.fromisoformat(entry['expiresOn'])
+
+        with self._lock:
+            renewed = expires_on != self.expires_on
+            self.scheme, self.token, self.expires_on = scheme, token, expires_on
+            self.subscription_id = subscription_id
+            if renewed:
+                self.refreshes += 1
+
+        LOG.debug('ARM token valid until %s', expires_on)
+        return renewed
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._refresh_loop, name='token-refresh', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _refresh_loop(self):
+        while not self._stopped.is_set():
+            with self._lock:
+                refresh_at = self.expires_on - self._refresh_margin
+            delay = max((refresh_at - datetime.now()).total_seconds(), 0)
+
+            if self._stopped.wait(delay):
+                return
+
+            try:
+                renewed = self.refresh()
+            except Exception as ex:
+                LOG.warning('Unable to refresh ARM token: %s', ex)
+                renewed = False
+
+            if not renewed and self._stopped.wait(TOKEN_REFRESH_RETRY_SECONDS):
+                return
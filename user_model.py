@@ -0,0 +1,43 @@
+# encoding: utf-8
+
+"""
+The `User` table written by the relational test case and the relational
+benchmark, kept free of the Azure harness so standalone scripts can import it.
+"""
+
+import random
+
+from sqlalchemy import Column, Integer, String
+from sqlalchemy.ext.declarative import declarative_base
+
+Base = declarative_base()
+
+
+def make_name():
+    """
+    First names are the top 10 baby names of 2017 as defined by the SSA at
+    https://www.ssa.gov/oact/babynames/ , and the last names are the most
+    frequently occurring surnames from the 2010 census, as defined by the
+    Census at
+    https://www.census.gov/topics/population/genealogy/data/2010_surnames.html
+    """
+
+    first_names = ["Liam", "Emma", "Noah", "Olivia", "William", "Ava", "James",
+                   "Isabella", "Logan", "Sophia", "Benjamin", "Mia", "Mason",
+                   "Charlotte", "Elijah", "Amelia", "Oliver", "Evelyn", "Jacob",
+                   "Abigail"]
+
+    last_names = ["Smith", "Johnson", "Williams", "Brown", "Jones", "Garcia",
+                  "Miller", "Davis", "Rodriguez", "Martínez"]
+
+    first_name = random.choice(first_names)
+    last_name = random.choice(last_names)
+
+    return (first_name.lower(), " ".join([first_name, last_name]))
+
+
+class User(Base):
+    __tablename__ = "users"
+    id = Column(Integer, primary_key=True)
+    name = Column(String(128))
+    fullname = Column(String(128))
@@ -1,42 +1,53 @@
 # encoding: utf-8
 
 import contextlib
-import paramiko
-import sqlalchemy
+import importlib
 
-from functools import lru_cache
+from functools import partial
 from logging import FileHandler, Formatter, StreamHandler, getLogger
 from os.path import expanduser
 from pathlib import Path
 from contextlib import contextmanager
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from urllib.parse import urlparse
 import random
+import shlex
+import threading
 from ipaddress import ip_address
 from string import ascii_letters, digits
-from time import sleep
-import socket
-from datetime import timedelta, datetime, timezone
-
-from azure.common.client_factory import get_client_from_auth_file, get_client_from_cli_profile
-from azure.mgmt.resource import ResourceManagementClient
-from azure.mgmt.storage import StorageManagementClient
-from azure.mgmt.network import NetworkManagementClient
-from azure.mgmt.compute import ComputeManagementClient
-from azure.mgmt.rdbms.mysql import MySQLManagementClient
-from azure.storage.blob import BlockBlobService
-from msrestazure.azure_exceptions import ClientException
-from environs import Env
+from time import monotonic
+from uuid import uuid4
 
-from sqlalchemy import create_engine
-from sqlalchemy.engine.base import Engine
-from sqlalchemy.exc import SQLAlchemyError
+from environs import Env
 
 from tests.metrics import metrics
 
-from hackaton_storage import create_storage_account
-from hackaton_compute import create_disk, attach_disk, detach_disk, deploy_shared_network, deploy_vm_networking, deploy_vm, execute_script
-from hackaton_mysql import create_mysql_database
+from blob_cache import BlobCache
+from blob_transfer import (
+    DEFAULT_BLOCK_SIZE,
+    DEFAULT_CONCURRENCY,
+    download_into,
+    get_verified_blob,
+    put_verified_blob,
+    upload_stream,
+)
+from client_factory import ClientFactory
+from compute_pool import ComputePool
+from readiness import Backoff, wait_for_ports, wait_until
+from remote_exec import RunCommandBackend, SSHExecBackend, run_script
+from sftp_transfer import (
+    DEFAULT_PREFETCH_BYTES,
+    DEFAULT_READ_REQUEST_SIZE,
+    DEFAULT_WINDOW_SIZE,
+    DEFAULT_WRITE_REQUEST_SIZE,
+    download as sftp_download,
+    open_sftp,
+    upload as sftp_upload,
+)
+from registry import FutureRegistry
+from teardown import DeletionTracker
 
 ##############################################################################
 # Global variables and type definitions
@@ -63,6 +74,46 @@ ADMIN_USERNAME = 'localadmin'
 MOUNT_NAME = '/datadisk'
 SSH_PUBLIC_KEY = expanduser(ENV('SSH_PUBLIC_KEY', CWD / 'my_key.pub'))
 SSH_PRIVATE_KEY = expanduser(ENV('SSH_PRIVATE_KEY', CWD / 'my_key'))
+COMPUTE_POOL_SIZE = ENV.int('COMPUTE_POOL_SIZE', 0)
+COMPUTE_POOL_LEASE_TIMEOUT_SECONDS = ENV.float('COMPUTE_POOL_LEASE_TIMEOUT_SECONDS', 900)
+TEARDOWN_DEADLINE_SECONDS = ENV.float('TEARDOWN_DEADLINE_SECONDS', 1800)
+MAX_WAIT_TIME_DATABASE_SECONDS = ENV.int('MAX_WAIT_TIME_DATABASE_SECONDS', 120)
+MAX_WAIT_TIME_SSH_SECONDS = ENV.int('MAX_WAIT_TIME_SSH_SECONDS', 300)
+PORT_CHECK_TIMEOUT_SECONDS = ENV.float('PORT_CHECK_TIMEOUT_SECONDS', 1)
+READINESS_BACKOFF = Backoff(maximum=ENV.float('PORT_CHECK_POLLING_INTERVAL', 1))
+OBJECT_STORAGE_BLOCK_SIZE = ENV.int('OBJECT_STORAGE_BLOCK_SIZE', DEFAULT_BLOCK_SIZE)
+OBJECT_STORAGE_CONCURRENCY = ENV.int('OBJECT_STORAGE_CONCURRENCY', DEFAULT_CONCURRENCY)
+OBJECT_STORAGE_PAGE_SIZE = ENV.int('OBJECT_STORAGE_PAGE_SIZE', 1000)
+# Start the storage account of the resource group of a case using object
+# storage as soon as the group exists.
+STORAGE_PREPROVISION = ENV.bool('STORAGE_PREPROVISION', True)
+# Threads creating shared subnets, storage accounts and containers, per kind
+# of resource; as many as the cases running at once is enough.
+SHARED_RESOURCE_WORKERS = ENV.int('SHARED_RESOURCE_WORKERS', 32)
+OBJECT_STORAGE_CACHE_DIR = ENV('OBJECT_STORAGE_CACHE_DIR', '')
+OBJECT_STORAGE_CACHE_MAX_BYTES = ENV.int('OBJECT_STORAGE_CACHE_MAX_BYTES', 256 * 1024 * 1024)
+MYSQL_POOL_SIZE = ENV.int('MYSQL_POOL_SIZE', 5)
+MYSQL_MAX_OVERFLOW = ENV.int('MYSQL_MAX_OVERFLOW', 10)
+MYSQL_POOL_PRE_PING = ENV.bool('MYSQL_POOL_PRE_PING', True)
+MYSQL_POOL_RECYCLE_SECONDS = ENV.int('MYSQL_POOL_RECYCLE_SECONDS', 1800)
+MYSQL_PREWARM_CONNECTIONS = ENV.int('MYSQL_PREWARM_CONNECTIONS', MYSQL_POOL_SIZE)
+SFTP_WINDOW_SIZE = ENV.int('SFTP_WINDOW_SIZE', DEFAULT_WINDOW_SIZE)
+SFTP_WRITE_REQUEST_SIZE = ENV.int('SFTP_WRITE_REQUEST_SIZE', DEFAULT_WRITE_REQUEST_SIZE)
+SFTP_READ_REQUEST_SIZE = ENV.int('SFTP_READ_REQUEST_SIZE', DEFAULT_READ_REQUEST_SIZE)
+SFTP_PREFETCH_BYTES = ENV.int('SFTP_PREFETCH_BYTES', DEFAULT_PREFETCH_BYTES)
+# "azure", or "offline" for the local stand-in of offline_backend.
+BACKEND = ENV('BACKEND', 'azure')
+OFFLINE_ROOT = ENV('OFFLINE_ROOT', '')
+OFFLINE_LRO_LATENCY_SECONDS = ENV.float('OFFLINE_LRO_LATENCY_SECONDS', 0.5)
+OFFLINE_CALL_LATENCY_SECONDS = ENV.float('OFFLINE_CALL_LATENCY_SECONDS', 0.05)
+OFFLINE_LATENCY_JITTER = ENV.float('OFFLINE_LATENCY_JITTER', 0.2)
+OFFLINE_MYSQL_HOST = ENV('OFFLINE_MYSQL_HOST', '')
+OFFLINE_MYSQL_PORT = ENV.int('OFFLINE_MYSQL_PORT', MYSQL_PORT)
+
+if BACKEND not in ('azure', 'offline'):
+    raise ValueError('Unknown BACKEND {!r}, expected "azure" or "offline"'.format(BACKEND))
+# Deletions of the offline backend complete in well under a second.
+TEARDOWN_POLLING_INTERVAL_SECONDS = ENV.float('TEARDOWN_POLLING_INTERVAL_SECONDS', 0.1 if BACKEND == 'offline' else 5)
 
 
 ObjectStorageHandle = namedtuple('ObjectStorageHandle', ['blob_client', 'container_name'])
@@ -70,16 +121,91 @@ StorageHandle = namedtuple('StorageHandle', ['account_name', 'account_key'])
 MysqlHandle = namedtuple('MysqlHandle', ['user', 'password', 'host', 'port', 'database', 'connect_args', 'connector'])
 ComputeHandle = namedtuple('ComputeHandle', ['resource_group', 'name', 'host', 'port', 'username'])
 BlockStorageHandle = namedtuple('BlockStorageHandle', ['id', 'resource_group', 'name'])
+DiskFormat = namedtuple('DiskFormat', ['filesystem_uuid', 'formatted'])
+
+# Management clients by name, imported on first use by `_new_client`: the
+# SDKs take longer to import than most test cases take to start.
+_CLIENT_TYPES = {
+    'resource': ('azure.mgmt.resource', 'ResourceManagementClient'),
+    'storage': ('azure.mgmt.storage', 'StorageManagementClient'),
+    'network': ('azure.mgmt.network', 'NetworkManagementClient'),
+    'compute': ('azure.mgmt.compute', 'ComputeManagementClient'),
+    'mysql': ('azure.mgmt.rdbms.mysql', 'MySQLManagementClient'),
+}
+
+
+def _deferred(module_name, function_name):
+    """Return a function calling `module_name.function_name`, importing the module on first call."""
+    def call(*args, **kwargs):
+        return getattr(importlib.import_module(module_name), function_name)(*args, **kwargs)
+    call.__name__ = function_name
+    return call
+
+
+create_storage_account = _deferred('hackaton_storage', 'create_storage_account')
+create_disk = _deferred('hackaton_compute', 'create_disk')
+attach_disk = _deferred('hackaton_compute', 'attach_disk')
+detach_disk = _deferred('hackaton_compute', 'detach_disk')
+deploy_shared_network = _deferred('hackaton_compute', 'deploy_shared_network')
+deploy_vms = _deferred('hackaton_compute', 'deploy_vms')
+execute_script = _deferred('hackaton_compute', 'execute_script')
+create_mysql_database = _deferred('hackaton_mysql', 'create_mysql_database')
 
 # Global configuration of the environment to run tests in.
 
+_CLIENTS = ClientFactory(
+    base_url=ENV('ARM_BASE_URL', ''),
+    pool_size=ENV.int('ARM_HTTP_POOL_SIZE', 16),
+)
+_ENVIRONMENT = contextlib.ExitStack()
+_COMPUTE_POOL = None
+_DELETIONS = DeletionTracker(polling_interval_seconds=TEARDOWN_POLLING_INTERVAL_SECONDS)
+_LAZY_LOCK = threading.Lock()
+
+# Pooled SSH transports and sqlalchemy engines, created with the first SSH
+# client or engine so paramiko and sqlalchemy are only imported when needed.
+_SSH = None
+_ENGINES = None
+# Local stand-in for Azure when BACKEND is "offline", created on first use.
+_OFFLINE = None
+_REMOTE_EXEC_BACKENDS = [
+    SSHExecBackend(lambda compute: create_compute_ssh_client(compute)),
+    RunCommandBackend(execute_script, lambda: _new_client('compute')),
+]
+
+# Read-through cache under object_storage_read, enabled by OBJECT_STORAGE_CACHE_DIR.
+_BLOB_CACHE = BlobCache(expanduser(OBJECT_STORAGE_CACHE_DIR), OBJECT_STORAGE_CACHE_MAX_BYTES) if OBJECT_STORAGE_CACHE_DIR else None
+
+# Filesystem state of every block storage instance, keyed by disk id.
+_DISK_FORMATS = {}
+_DISK_FORMATS_LOCK = threading.Lock()
+
+# Shared subnet ids, keyed by (resource group, location).
+_SUBNETS = FutureRegistry('subnet', max_workers=SHARED_RESOURCE_WORKERS)
+
+# Storage accounts and the blob clients on them, keyed by resource group.
+_STORAGE_ACCOUNTS = FutureRegistry('storage-account', max_workers=SHARED_RESOURCE_WORKERS)
+_BLOB_SERVICES = FutureRegistry('blob-service', max_workers=SHARED_RESOURCE_WORKERS)
+
 
 def setup_environment():
     """
     Preform any initial configuring of the environment needed to preform any
     of the calls in this file.
     """
+    global _COMPUTE_POOL
 
+    if COMPUTE_POOL_SIZE > 0:
+        resource_group_name = '{}pool{}'.format(PREFIX, _random_string(20))
+        _ENVIRONMENT.enter_context(_deploy_resource_group(resource_group_name, RESOURCE_GROUP_LOCATION))
+
+        _COMPUTE_POOL = ComputePool(
+            size=COMPUTE_POOL_SIZE,
+            provision=partial(_deploy_compute_instances, resource_group_name),
+            reset=_reset_compute_instance,
+        )
+        _ENVIRONMENT.callback(_COMPUTE_POOL.drain)
+        _COMPUTE_POOL.fill()
 
 
 def teardown_environment():
@@ -89,6 +215,34 @@ def teardown_environment():
     This should completley shut down or destroy any running resources that were
     spun up as a result of running the functions in this file.
     """
+    global _COMPUTE_POOL, _BLOB_CACHE
+
+    _ENVIRONMENT.close()
+    _COMPUTE_POOL = None
+    if _SSH is not None:
+        _SSH.close_all()
+    if _ENGINES is not None:
+        _ENGINES.dispose_all()
+    if _BLOB_CACHE is not None:
+        _BLOB_CACHE.close()
+        _BLOB_CACHE = None
+
+    LOG.info('Waiting up to %ds for resource group deletions', TEARDOWN_DEADLINE_SECONDS)
+    _DELETIONS.wait(TEARDOWN_DEADLINE_SECONDS)
+
+    if _OFFLINE is not None:
+        _OFFLINE.close()
+    _CLIENTS.close()
+
+
+def resource_group_deletions():
+    """
+    Resource group deletions of the run, as `teardown.Deletion` tuples.
+
+    :returns: the completed deletions, slowest first, and the ones still
+              pending after :func:`teardown_environment` gave up waiting.
+    """
+    return _DELETIONS.summary()
 
 
 # Compute-specficic helpers to create, destroy and access resources.
@@ -104,21 +258,26 @@ def create_compute_instance(resource_group_name):
     This context manager should yield a handle to the new image, in a format
     that other functions in this file can use (such as
     `create_object_storage_instance`).
+
+    When a warm pool is configured through `COMPUTE_POOL_SIZE`, the instance
+    is leased from it instead of being created.
     """
+    with _acquire_compute_instances(resource_group_name, 1) as handles:
+        yield handles[0]
 
-    vm_name = 'vm{}'.format(_random_string(20))
 
-    with open(SSH_PUBLIC_KEY, 'r') as f:
-        ssh_public_key = f.read()
+@metrics
+@contextlib.contextmanager
+def create_compute_instances(resource_group_name, count):
+    """
+    Create `count` new compute instances at once.
 
-    network_client = _new_client(NetworkManagementClient)
-    compute_client = _new_client(ComputeManagementClient)
-    
-    subnet_id = deploy_shared_network(resource_group_name, RESOURCE_GROUP_LOCATION, network_client)
-    nic_id, public_ip = deploy_vm_networking(resource_group_name, RESOURCE_GROUP_LOCATION, vm_name, subnet_id, network_client)
-    vm = deploy_vm(resource_group_name, RESOURCE_GROUP_LOCATION, vm_name, ADMIN_USERNAME, nic_id, ssh_public_key, compute_client)
-    
-    yield ComputeHandle(resource_group=resource_group_name, name=vm_name, host=public_ip, port=22, username=ADMIN_USERNAME)
+    The networking and VM deployments of every instance run as one operation
+    graph, so provisioning several VMs takes about as long as provisioning
+    one. Yields a list of handles, one per instance.
+    """
+    with _acquire_compute_instances(resource_group_name, count) as handles:
+        yield handles
 
 
 def create_compute_ssh_client(compute):
@@ -127,15 +286,43 @@ def create_compute_ssh_client(compute):
     create a `paramiko.client.SSHClient`
 
     be sure to `.connect()` to the machine before returning the SSHClient handle.
+
+    The client runs on a transport pooled per instance, so only the first
+    call for an instance pays for the handshake.
     """
-    client = paramiko.SSHClient()
-    LOG.debug('Loading system host keys...')
-    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    client.load_system_host_keys()
-    client.connect(compute.host, compute.port, compute.username, key_filename=SSH_PRIVATE_KEY)
-    LOG.debug('Connected!')
+    return _ssh_pool().client(compute)
+
+
+def compute_upload(compute_handle, source, path):
+    """Copy local data to a compute instance over pipelined SFTP.
+
+    :param compute_handle: handle provided by :func:`~create_compute_instance`.
+    :param source: name of a local file, or a bytes-like object such as a
+                   `memoryview` or `mmap`, sent without being copied first.
+    :param path: remote path to write, e.g. under an attached disk.
+    :returns: a `sftp_transfer.Transfer` with the size and MB/s of the copy.
+    """
+    with contextlib.closing(_open_sftp(compute_handle)) as sftp:
+        return sftp_upload(sftp, source, path, request_size=SFTP_WRITE_REQUEST_SIZE)
 
-    return client
+
+def compute_download(compute_handle, path, destination):
+    """Copy a file from a compute instance over prefetched SFTP.
+
+    :param compute_handle: handle provided by :func:`~create_compute_instance`.
+    :param path: remote path to read.
+    :param destination: name of a local file, or a writable buffer such as a
+                        `bytearray` or `mmap` large enough for the file.
+    :returns: a `sftp_transfer.Transfer` with the size and MB/s of the copy.
+    """
+    with contextlib.closing(_open_sftp(compute_handle)) as sftp:
+        return sftp_download(
+            sftp,
+            path,
+            destination,
+            request_size=SFTP_READ_REQUEST_SIZE,
+            prefetch_bytes=SFTP_PREFETCH_BYTES,
+        )
 
 
 # Object storage specific helpers to create, destroy and access resources.
@@ -146,35 +333,14 @@ def create_compute_ssh_client(compute):
 def create_object_storage_instance(resource_group_name):
     """Create a new object storage instance.
 
+    The storage account of a resource group is created once, in the
+    background as soon as the group exists when pre-provisioned, and its blob
+    client is shared by every object storage instance of that group. Each
+    instance gets a container of its own.
+
     :returns: a handle to the object storage instance in a format that other functions in this file can use.
     """
-    container_name = '{}container'.format(PREFIX)
-
-    #storage_account_name = '{}storage{}'.format(PREFIX, _random_string(20)).lower()[:24]
-
-    try:
-        storage = _deploy_storage(
-            resource_group_name=resource_group_name,
-            location=RESOURCE_GROUP_LOCATION,
-            #account_name=storage_account_name,
-        )
-
-        blob_client = BlockBlobService(
-            account_name=storage.account_name,
-            account_key=storage.account_key,
-        )
-
-        blob_client.create_container(container_name, fail_on_exist=False)
-    except ClientException as ex:
-        LOG.debug('Error in storage account %s or container %s: %s', storage.account_name, container_name, ex)
-        raise
-    else:
-        LOG.debug('Storage account %s and container %s are available', storage.account_name, container_name)
-
-    yield ObjectStorageHandle(
-        blob_client=blob_client,
-        container_name=container_name,
-    )
+    yield _deploy_object_storage(resource_group_name)
 
 
 def object_storage_list(handle):
@@ -183,7 +349,32 @@ def object_storage_list(handle):
     :param handle: handle provided by :func:`~create_object_storage_instance`.
     :returns: a list of object names.
     """
-    return [blob.name for blob in handle.blob_client.list_blobs(handle.container_name)]
+    return list(object_storage_iter(handle))
+
+
+def object_storage_iter(handle, prefix=None, page_size=None):
+    """Lazily iterate over the objects of the object store, page by page.
+
+    :param handle: handle provided by :func:`~create_object_storage_instance`.
+    :param prefix: only list objects whose name starts with this prefix.
+    :param page_size: number of objects requested per listing call.
+    :returns: a generator of object names, yielding as each page arrives.
+    """
+    page_size = page_size or OBJECT_STORAGE_PAGE_SIZE
+    marker = None
+    while True:
+        page = handle.blob_client.list_blobs(
+            handle.container_name,
+            prefix=prefix,
+            num_results=page_size,
+            marker=marker,
+        )
+        for blob in page:
+            yield blob.name
+
+        marker = page.next_marker
+        if not marker:
+            return
 
 
 def object_storage_delete(handle, path):
@@ -192,9 +383,40 @@ def object_storage_delete(handle, path):
     :param handle: handle provided by :func:`~create_object_storage_instance`.
     :param path: path of the object to delete.
     """
+    _invalidate_cached_object(handle, path)
     handle.blob_client.delete_blob(handle.container_name, path)
 
 
+def object_storage_delete_many(handle, paths):
+    """Delete many objects, several requests at a time.
+
+    :param handle: handle provided by :func:`~create_object_storage_instance`.
+    :param paths: iterable of paths of the objects to delete, consumed lazily.
+    :returns: a mapping of path to None when deleted, or to the exception
+              raised when deleting it failed.
+    """
+    from azure.common import AzureException
+
+    def delete(path):
+        _invalidate_cached_object(handle, path)
+        try:
+            handle.blob_client.delete_blob(handle.container_name, path)
+        except AzureException as ex:
+            LOG.debug('Unable to delete %s: %s', path, ex)
+            return ex
+
+    results = {}
+    paths = iter(paths)
+    with ThreadPoolExecutor(max_workers=OBJECT_STORAGE_CONCURRENCY, thread_name_prefix='delete-blob') as executor:
+        while True:
+            batch = list(islice(paths, OBJECT_STORAGE_PAGE_SIZE))
+            if not batch:
+                break
+            results.update(zip(batch, executor.map(delete, batch)))
+
+    return results
+
+
 def object_storage_write(handle, path, data):
     """Write the data held in memory to the object storage instance.
 
@@ -202,7 +424,15 @@ def object_storage_write(handle, path, data):
     :param path: path of the object to write.
     :param data: the bytes to write.
     """
-    handle.blob_client.create_blob_from_bytes(handle.container_name, path, data)
+    _invalidate_cached_object(handle, path)
+    put_verified_blob(
+        handle.blob_client,
+        handle.container_name,
+        path,
+        data,
+        block_size=OBJECT_STORAGE_BLOCK_SIZE,
+        concurrency=OBJECT_STORAGE_CONCURRENCY,
+    )
 
 
 def object_storage_read(handle, path):
@@ -212,7 +442,55 @@ def object_storage_read(handle, path):
     :param path: path of the object to read.
     :returns: the bytes read from the storage.
     """
-    return handle.blob_client.get_blob_to_bytes(handle.container_name, path).content
+    if _BLOB_CACHE is not None:
+        return _BLOB_CACHE.read(handle.blob_client, handle.container_name, path)
+    return get_verified_blob(handle.blob_client, handle.container_name, path).content
+
+
+def object_storage_write_stream(handle, path, source):
+    """Write a stream of data to the object storage instance, block by block.
+
+    Blocks are uploaded in parallel and only a bounded number of them is held
+    in memory, however large the object is.
+
+    :param handle: handle provided by :func:`~create_object_storage_instance`.
+    :param path: path of the object to write.
+    :param source: a binary file object or an iterable of bytes.
+    :returns: the number of bytes written.
+    """
+    _invalidate_cached_object(handle, path)
+    return upload_stream(
+        handle.blob_client,
+        handle.container_name,
+        path,
+        source,
+        block_size=OBJECT_STORAGE_BLOCK_SIZE,
+        concurrency=OBJECT_STORAGE_CONCURRENCY,
+    )
+
+
+def object_storage_read_into(handle, path, buffer):
+    """Read an object into a caller-supplied buffer with parallel ranged reads.
+
+    :param handle: handle provided by :func:`~create_object_storage_instance`.
+    :param path: path of the object to read.
+    :param buffer: a writable buffer at least as large as the object, such as
+                   a `bytearray`, `memoryview` or `mmap`.
+    :returns: the number of bytes read.
+    """
+    return download_into(
+        handle.blob_client,
+        handle.container_name,
+        path,
+        buffer,
+        block_size=OBJECT_STORAGE_BLOCK_SIZE,
+        concurrency=OBJECT_STORAGE_CONCURRENCY,
+    )
+
+
+def _invalidate_cached_object(handle, path):
+    if _BLOB_CACHE is not None:
+        _BLOB_CACHE.invalidate(handle.blob_client, handle.container_name, path)
 
 
 # Block storage specific helpers to create, destroy and attach resources.
@@ -228,70 +506,102 @@ def create_block_storage_instance(resource_group_name):
     This context manager should yield a handle to the block storage instance,
     in a format that other functions in this file can use.
     """
-    compute_client = _new_client(ComputeManagementClient)
-    yield create_disk(resource_group_name, RESOURCE_GROUP_LOCATION, compute_client)
+    compute_client = _new_client('compute')
+    disk_id = create_disk(resource_group_name, RESOURCE_GROUP_LOCATION, compute_client)
+
+    handle = BlockStorageHandle(id=disk_id, resource_group=resource_group_name, name=disk_id.split('/')[-1])
+    _set_disk_format(handle, DiskFormat(filesystem_uuid=str(uuid4()), formatted=False))
+    try:
+        yield handle
+    finally:
+        with _DISK_FORMATS_LOCK:
+            _DISK_FORMATS.pop(handle.id, None)
 
 
 def attach_block_storage_to_compute(compute_handle, storage_handle):
-    client = _new_client(ComputeManagementClient)
-
-    LOG.debug("Attaching disk %s to %s", storage_handle, compute_handle.name)
-    attach_disk(
-        compute_handle.resource_group,
-        compute_handle.name,
-        storage_handle,
-        client
-    )
-    LOG.debug("Disk attached")
+    client = _new_client('compute')
+
+    LOG.debug("Attaching disk %s to %s", storage_handle.name, compute_handle.name)
+    started_at = monotonic()
+    with metrics.span('attach_disk', 'arm', disk=storage_handle.name):
+        lun = attach_disk(
+            compute_handle.resource_group,
+            compute_handle.name,
+            storage_handle.id,
+            client
+        )
+    attached_at = monotonic()
+    LOG.debug("Disk attached at LUN %d", lun)
 
     LOG.debug("Execute disk preparation script")
     script_path = CWD / 'resources' / 'mount_data_disk.sh'
 
-    # with create_compute_ssh_client(compute_handle) as ssh:
-    #     sftp = ssh.open_sftp()
-
-    #     with sftp.file('/tmp/mount_data_disk.sh', 'wb') as remote:
-    #         with open(script_path, 'rb') as script:
-    #             remote.write(script.read())
-
-    #     stdin, stdout, stderr = ssh.exec_command('/bin/bash /tmp/mount_data_disk.sh')
-        
-    #     LOG.debug('%s %s', stdout.read(), stderr.read())
-
     with open(script_path, 'r') as script:
         data = script.read()
 
-    output = execute_script(
-        compute_handle.resource_group,
-        compute_handle.name,
-        data.splitlines(),
-        client
+    disk_format = _get_disk_format(storage_handle)
+    mode = 'mount' if disk_format.formatted else 'format'
+    LOG.debug("Disk %s needs %s (filesystem %s)", storage_handle.name, mode, disk_format.filesystem_uuid)
+
+    result = run_script(
+        compute_handle,
+        _with_variables(
+            data.splitlines(),
+            LUN=lun,
+            MODE=mode,
+            FS_UUID=disk_format.filesystem_uuid,
+            MOUNT=MOUNT_NAME,
+            OWNER=compute_handle.username,
+        ),
+        _REMOTE_EXEC_BACKENDS,
+        caller='attach_block_storage_to_compute',
     )
-
-    if output:
-        LOG.debug(output)  # stdout/stderr    
+    # run_script raises on a failure or on an unknown status, but the next
+    # attach only skips mkfs on a disk the script was seen to format.
+    if result.exit_status == 0:
+        _set_disk_format(storage_handle, disk_format._replace(formatted=True))
     LOG.debug("Disk preparation script executed")
+    metrics.record(
+        'attach_block_storage_to_compute',
+        'disk',
+        attach_time=attached_at - started_at,
+        attach_to_mount_time=monotonic() - attached_at,
+    )
 
-    return '/datadisk/demo'
+    return '{}/demo'.format(MOUNT_NAME)
 
 
 def remove_block_storage_from_compute(compute_handle, storage_handle):
-    # Try really hard to flush the files...    
-    with create_compute_ssh_client(compute_handle) as ssh:
-        stdin, stdout, stderr = ssh.exec_command('sudo sync')
-        LOG.debug('%s %s', stdout.read(), stderr.read())
-        stdin, stdout, stderr = ssh.exec_command('sudo sync')
-        LOG.debug('%s %s', stdout.read(), stderr.read())
-        
-    client = _new_client(ComputeManagementClient)
-    LOG.debug("Detaching disk %s to %s", storage_handle, compute_handle.name)
-    detach_disk(
-        compute_handle.resource_group,
-        compute_handle.name,
-        storage_handle,
-        client
+    LOG.debug("Flushing and unmounting %s on %s", MOUNT_NAME, compute_handle.name)
+    started_at = monotonic()
+    with open(CWD / 'resources' / 'unmount_data_disk.sh', 'r') as script:
+        data = script.read()
+
+    # The disk is only detached once the guest confirmed it was unmounted.
+    run_script(
+        compute_handle,
+        _with_variables(data.splitlines(), MOUNT=MOUNT_NAME),
+        _REMOTE_EXEC_BACKENDS,
+        caller='remove_block_storage_from_compute',
     )
+    flushed_at = monotonic()
+
+    client = _new_client('compute')
+    LOG.debug("Detaching disk %s to %s", storage_handle.name, compute_handle.name)
+    with metrics.span('detach_disk', 'arm', disk=storage_handle.name):
+        detach_disk(
+            compute_handle.resource_group,
+            compute_handle.name,
+            storage_handle.id,
+            client
+        )
     LOG.debug("Disk detached")
+    metrics.record(
+        'remove_block_storage_from_compute',
+        'disk',
+        flush_time=flushed_at - started_at,
+        detach_time=monotonic() - flushed_at,
+    )
 
 # Relational database specific helpers to create, destroy and access resources.
 
@@ -318,7 +628,11 @@ def create_relational_database_instance(resource_group_name):
         # server_name=server_name,
         # database_name=database_name,
     )
-    yield mysql
+    try:
+        yield mysql
+    finally:
+        if _ENGINES is not None:
+            _ENGINES.dispose(_engine_key(mysql))
 
 
 def create_relational_database_client(handle):
@@ -328,55 +642,192 @@ def create_relational_database_client(handle):
 
     This function is not expected to call `engine.connect()`, the test
     suite will do that on the value returned by this function.
+
+    The engine is shared by every call for the same database, and its pool
+    already holds pre-warmed connections when it is returned.
     """
-    _wait_for_port(
-        host=handle.host,
-        port=handle.port,
-        max_wait_time=timedelta(seconds=ENV.int('MAX_WAIT_TIME_DATABASE_SECONDS', 120)),
+    return _engine_registry().get(_engine_key(handle), _database_url(handle), _engine_connect_args(handle))
+
+
+@contextlib.contextmanager
+def _acquire_compute_instances(resource_group_name, count):
+    leased = []
+    if _COMPUTE_POOL is not None:
+        while len(leased) < count:
+            handle = _COMPUTE_POOL.lease(COMPUTE_POOL_LEASE_TIMEOUT_SECONDS)
+            if handle is None:
+                LOG.debug('No pooled VM available, creating a new one')
+                break
+            leased.append(handle)
+
+    fresh = []
+    try:
+        if len(leased) < count:
+            fresh = _deploy_compute_instances(resource_group_name, count - len(leased))
+        yield leased + fresh
+    finally:
+        for handle in fresh:
+            if _SSH is not None:
+                _SSH.discard(handle)
+        for handle in leased:
+            _COMPUTE_POOL.release(handle)
+
+
+def _connect_ssh(compute):
+    import paramiko
+
+    _wait_for_ports([(compute.host, compute.port)], MAX_WAIT_TIME_SSH_SECONDS)
+
+    client = paramiko.SSHClient()
+    LOG.debug('Loading system host keys...')
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    client.load_system_host_keys()
+    with metrics.span('ssh_connect', 'ssh', host=compute.name):
+        client.connect(compute.host, compute.port, compute.username, key_filename=SSH_PRIVATE_KEY)
+    LOG.debug('Connected!')
+
+    return client
+
+
+def _open_sftp(compute):
+    return open_sftp(
+        create_compute_ssh_client(compute),
+        window_size=SFTP_WINDOW_SIZE,
+        read_request_size=SFTP_READ_REQUEST_SIZE,
     )
 
-    LOG.debug('Creating sqlalchemy engine for %s:%s', handle.host, handle.port)
-    engine = create_engine(
-        '{connector}://{user}:{password}@{host}:{port}/{database}'.format(
-            connector=handle.connector,
-            user=handle.user,
-            password=handle.password,
-            host=handle.host,
-            port=handle.port,
-            database=handle.database,
-        ),
-        implicit_returning=False,
-        connect_args=handle.connect_args,
+
+def _reset_compute_instance(compute):
+    """Give a pooled VM a fresh home directory before it is leased again."""
+    script = (
+        'sudo umount -q {mount}; '
+        'find ~ -mindepth 1 -maxdepth 1 ! -name .ssh -exec rm -rf {{}} + && '
+        'cp -rT /etc/skel ~'
+    ).format(mount=MOUNT_NAME)
+
+    with create_compute_ssh_client(compute) as ssh:
+        stdin, stdout, stderr = ssh.exec_command(script)
+        status = stdout.channel.recv_exit_status()
+        if status != 0:
+            raise RuntimeError('Reset of {} failed ({}): {}'.format(compute.name, status, stderr.read()))
+
+
+def _deploy_compute_instances(resource_group_name, count):
+    vm_names = ['vm{}'.format(_random_string(20)) for _ in range(count)]
+
+    with open(SSH_PUBLIC_KEY, 'r') as f:
+        ssh_public_key = f.read()
+
+    network_client = _new_client('network')
+    compute_client = _new_client('compute')
+
+    subnet = _SUBNETS.submit(
+        (resource_group_name, RESOURCE_GROUP_LOCATION),
+        deploy_shared_network,
+        resource_group_name,
+        RESOURCE_GROUP_LOCATION,
+        network_client,
+    )
+
+    deployed = deploy_vms(
+        resource_group_name,
+        RESOURCE_GROUP_LOCATION,
+        vm_names,
+        ADMIN_USERNAME,
+        ssh_public_key,
+        network_client,
+        compute_client,
+        subnet_id=subnet,
     )
 
-    _wait_for_sqlalchemy(engine)
+    handles = []
+    for vm_name in vm_names:
+        _, public_ip = deployed[vm_name]
+        LOG.debug('VM %s is available at %s', vm_name, public_ip)
+        handles.append(ComputeHandle(resource_group=resource_group_name, name=vm_name, host=public_ip, port=_ssh_port(vm_name), username=ADMIN_USERNAME))
+
+    _wait_for_ports([(handle.host, handle.port) for handle in handles], MAX_WAIT_TIME_SSH_SECONDS)
 
-    return engine
+    return handles
 
 
 def _random_string(length, alphabet = ascii_letters + digits) -> str:
     return ''.join(random.choice(alphabet) for _ in range(length))  # nosec
 
 
-@lru_cache(maxsize=32)
 def _new_client(client_type):
-    client_args = {}
-
-    base_url = ENV('ARM_BASE_URL', '')
-    if base_url:
-        client_args['base_url'] = base_url
-        LOG.debug('Using custom ARM endpoint %s for %s', base_url, client_type.__name__)
-    else:
-        LOG.debug('Using default ARM endpoint for %s', client_type.__name__)
-    return get_client_from_cli_profile(client_type, **client_args)
+    """Return the shared management client named `client_type` in `_CLIENT_TYPES`."""
+    if BACKEND == 'offline':
+        return _offline_cloud().client(client_type)
+    module_name, class_name = _CLIENT_TYPES[client_type]
+    return _CLIENTS.get(getattr(importlib.import_module(module_name), class_name))
+
+
+def _ssh_port(vm_name):
+    if BACKEND == 'offline':
+        return _offline_cloud().ssh_port(vm_name)
+    return 22
+
+
+def _ssh_pool():
+    global _SSH
+
+    with _LAZY_LOCK:
+        if _SSH is None:
+            from ssh_pool import TransportPool
+            _SSH = TransportPool(
+                connect=_connect_ssh,
+                keepalive_seconds=ENV.int('SSH_KEEPALIVE_SECONDS', 15),
+            )
+        return _SSH
+
+
+def _engine_registry():
+    global _ENGINES
+
+    with _LAZY_LOCK:
+        if _ENGINES is None:
+            from engine_registry import EngineRegistry
+            _ENGINES = EngineRegistry(
+                wait_until_ready=lambda engine: _wait_for_database(engine, MAX_WAIT_TIME_DATABASE_SECONDS),
+                prewarm=min(MYSQL_PREWARM_CONNECTIONS, MYSQL_POOL_SIZE + MYSQL_MAX_OVERFLOW),
+                pool_size=MYSQL_POOL_SIZE,
+                max_overflow=MYSQL_MAX_OVERFLOW,
+                pool_pre_ping=MYSQL_POOL_PRE_PING,
+                pool_recycle=MYSQL_POOL_RECYCLE_SECONDS,
+                implicit_returning=False,
+            )
+        return _ENGINES
+
+
+def _offline_cloud():
+    global _OFFLINE
+
+    with _LAZY_LOCK:
+        if _OFFLINE is None:
+            from offline_backend import Latency, OfflineCloud
+            _OFFLINE = OfflineCloud(
+                directory=expanduser(OFFLINE_ROOT),
+                latency=Latency(
+                    lro_seconds=OFFLINE_LRO_LATENCY_SECONDS,
+                    call_seconds=OFFLINE_CALL_LATENCY_SECONDS,
+                    jitter=OFFLINE_LATENCY_JITTER,
+                ),
+                mysql_host=OFFLINE_MYSQL_HOST,
+                mysql_port=OFFLINE_MYSQL_PORT,
+            )
+        return _OFFLINE
 
 
 @contextlib.contextmanager
 def _deploy_resource_group(
         resource_group_name: str,
         resource_group_location: str,
+        preprovision_storage: bool = False,
 ):
-    client = _new_client(ResourceManagementClient)
+    from msrestazure.azure_exceptions import ClientException
+
+    client = _new_client('resource')
 
     LOG.debug('Creating resource group %s', resource_group_name)
     client.resource_groups.create_or_update(
@@ -384,29 +835,49 @@ def _deploy_resource_group(
         parameters={'location': resource_group_location},
     )
 
+    if preprovision_storage:
+        _STORAGE_ACCOUNTS.submit(
+            resource_group_name,
+            _deploy_storage,
+            resource_group_name=resource_group_name,
+            location=resource_group_location,
+        )
+
     yield
 
     LOG.debug('Cleaning up resource group %s', resource_group_name)
+    _SUBNETS.discard(lambda key: key[0] == resource_group_name)
+    for future in _STORAGE_ACCOUNTS.discard(lambda key: key == resource_group_name):
+        # Do not delete the group under a storage account still being created.
+        if not future.cancel():
+            try:
+                future.result()
+            except Exception as ex:
+                LOG.warning('Error creating the storage account of %s: %s', resource_group_name, ex)
+    _BLOB_SERVICES.discard(lambda key: key == resource_group_name)
     try:
-        client.resource_groups.delete(resource_group_name, polling=False)
+        poller = client.resource_groups.delete(resource_group_name)
     except ClientException as ex:
         LOG.warning('Error deleting resource group %s: %s', resource_group_name, ex)
+    else:
+        _DELETIONS.track(resource_group_name, poller)
 
 
 
 def _deploy_storage(
         resource_group_name: str,
         location: str,
-        #account_name: str,
         sku: str = ENV('STORAGE_SKU', 'Standard_LRS'),
 ):
-    client = _new_client(StorageManagementClient)
+    client = _new_client('storage')
 
     LOG.debug('Creating storage account')
 
     account_name, account_key = create_storage_account(
         resource_group_name,
-        client        
+        client,
+        location=location,
+        sku=sku,
     )
     LOG.debug('Created storage account %s', account_name)
 
@@ -416,6 +887,49 @@ def _deploy_storage(
     )
 
 
+def _deploy_object_storage(resource_group_name):
+    from azure.common import AzureException
+
+    container_name = '{}container{}'.format(PREFIX, _random_string(12)).lower()
+
+    blob_client = _BLOB_SERVICES.get(resource_group_name, _deploy_blob_service, resource_group_name)
+
+    try:
+        blob_client.create_container(container_name, fail_on_exist=True)
+    except AzureException as ex:
+        LOG.debug('Error in storage account %s or container %s: %s', blob_client.account_name, container_name, ex)
+        raise
+    else:
+        LOG.debug('Storage account %s and container %s are available', blob_client.account_name, container_name)
+
+    return ObjectStorageHandle(
+        blob_client=blob_client,
+        container_name=container_name,
+    )
+
+
+def _deploy_blob_service(resource_group_name):
+    storage = _STORAGE_ACCOUNTS.get(
+        resource_group_name,
+        _deploy_storage,
+        resource_group_name=resource_group_name,
+        location=RESOURCE_GROUP_LOCATION,
+    )
+    return _blob_service(storage)
+
+
+def _blob_service(storage):
+    if BACKEND == 'offline':
+        return _offline_cloud().blob_service(storage.account_name, storage.account_key)
+
+    from azure.storage.blob import BlockBlobService
+
+    return BlockBlobService(
+        account_name=storage.account_name,
+        account_key=storage.account_key,
+    )
+
+
 def _deploy_mysql(
         resource_group_name,
         location,
@@ -424,7 +938,7 @@ def _deploy_mysql(
         # server_name,
         # database_name,
 ):
-    client = _new_client(MySQLManagementClient)
+    client = _new_client('mysql')
 
     LOG.debug('Creating database and server')
 
@@ -432,11 +946,15 @@ def _deploy_mysql(
         resource_group_name,
         administrator_login,
         administrator_login_password,
-        client
+        client,
+        location=location,
     )
 
     LOG.debug('Done creating database, server and everything needed')
 
+    if BACKEND == 'offline':
+        return MysqlHandle(**_offline_cloud().database_connection(server_name, database_name))
+
     if _is_ip_address(host):
         user = administrator_login
     else:
@@ -460,6 +978,24 @@ def _deploy_mysql(
 # Utility functions
 ##############################################################################
 
+def _get_disk_format(storage_handle):
+    with _DISK_FORMATS_LOCK:
+        return _DISK_FORMATS[storage_handle.id]
+
+
+def _set_disk_format(storage_handle, disk_format):
+    with _DISK_FORMATS_LOCK:
+        _DISK_FORMATS[storage_handle.id] = disk_format
+
+
+def _with_variables(script_lines, **variables):
+    """Insert shell variable assignments right after the shebang of a script."""
+    assignments = ['{}={}'.format(name, shlex.quote(str(value))) for name, value in sorted(variables.items())]
+    if script_lines and script_lines[0].startswith('#!'):
+        return script_lines[:1] + assignments + script_lines[1:]
+    return assignments + script_lines
+
+
 def _is_ip_address(ip_or_fqdn: str) -> bool:
     try:
         ip_address(ip_or_fqdn)
@@ -469,65 +1005,70 @@ def _is_ip_address(ip_or_fqdn: str) -> bool:
         return True
 
 
-def _wait_for_sqlalchemy(engine, polling_interval_seconds=3):
-
-    while True:
-        try:
-            with engine.connect() as connection:
-                for _ in connection.execute('select 1'):
-                    pass
-        except SQLAlchemyError as ex:
-            LOG.debug('Unable to connect to database: %s', ex)
-        else:
-            LOG.debug('Database connection is available')
-            break
-
-        LOG.debug('Waiting for database connection')
-        sleep(polling_interval_seconds)
-
-
-def _wait_for_port(
-        host: str,
-        port: int,
-        max_wait_time,
-        polling_interval_seconds: float = ENV.float('PORT_CHECK_POLLING_INTERVAL', 1),
-) -> None:
-    start_time = _utcnow()
-
-    while True:
-        if _is_port_open(host, port):
-            break
+def _database_url(handle):
+    if handle.connector == 'sqlite':
+        return 'sqlite:///{}'.format(handle.database)
+    return '{connector}://{user}:{password}@{host}:{port}/{database}'.format(
+        connector=handle.connector,
+        user=handle.user,
+        password=handle.password,
+        host=handle.host,
+        port=handle.port,
+        database=handle.database,
+    )
 
-        if _utcnow() - start_time > max_wait_time:
-            raise ValueError('{}:{} was not available in time'.format(host, port))
 
-        LOG.debug('Waiting for %s:%d', host, port)
-        sleep(polling_interval_seconds)
+def _engine_key(handle):
+    # MysqlHandle holds a dict of connect_args and cannot be hashed itself.
+    return handle.connector, handle.user, handle.host, handle.port, handle.database
 
-def _utcnow():
-    now = datetime.utcnow()
-    now = now.replace(tzinfo=timezone.utc)
-    return now
 
-def _is_port_open(
-        host,
-        port,
-        socket_timeout_seconds = ENV.float('PORT_CHECK_TIMEOUT_SECONDS', 1),
-):
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    try:
-        sock.settimeout(socket_timeout_seconds)
-        result = sock.connect_ex((host, port))
-    except socket.error as ex:
-        LOG.debug('Unable to open socket %s:%d, reason: %s', host, port, ex)
-        return False
-    finally:
-        sock.close()
+def _engine_connect_args(handle):
+    """
+    Replace the `ssl` options of a pymysql handle with an SSL context resuming
+    TLS sessions, so only the first connection pays for a full handshake.
+    """
+    from engine_registry import resuming_ssl_context
+
+    connect_args = dict(handle.connect_args or {})
+    ssl_options = connect_args.get('ssl')
+    if handle.connector == 'mysql+pymysql' and isinstance(ssl_options, dict):
+        cafile = ssl_options.get('ca') or ssl_options.get('ca_cert')
+        if cafile:
+            connect_args['ssl'] = resuming_ssl_context(str(cafile), check_hostname=not _is_ip_address(handle.host))
+    return connect_args
+
+
+def _wait_for_database(engine, deadline_seconds):
+    started_at = monotonic()
+    if engine.url.host:
+        _wait_for_ports([(engine.url.host, engine.url.port)], deadline_seconds)
+    _wait_for_sqlalchemy(engine, max(deadline_seconds - (monotonic() - started_at), 0))
+
+
+def _wait_for_sqlalchemy(engine, deadline_seconds):
+    from sqlalchemy.exc import SQLAlchemyError
+
+    def select_one():
+        with engine.connect() as connection:
+            for _ in connection.execute('select 1'):
+                pass
+
+    with metrics.span('wait_for_database', 'wait', host=engine.url.host):
+        wait_until(
+            select_one,
+            name='database {}'.format(engine.url.host),
+            deadline_seconds=deadline_seconds,
+            errors=(SQLAlchemyError,),
+            backoff=READINESS_BACKOFF,
+        )
 
-    port_is_open = result == 0
-    if port_is_open:
-        LOG.debug('Socket %s:%d is open', host, port)
-    else:
-        LOG.debug('Socket %s:%d is not open, reason: %s', host, port, result)
 
-    return port_is_open
+def _wait_for_ports(targets, deadline_seconds):
+    with metrics.span('wait_for_ports', 'wait', targets=['{}:{}'.format(*target) for target in targets]):
+        return wait_for_ports(
+            targets,
+            deadline_seconds=deadline_seconds,
+            connect_timeout_seconds=PORT_CHECK_TIMEOUT_SECONDS,
+            backoff=READINESS_BACKOFF,
+        )